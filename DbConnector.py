@@ -1,6 +1,36 @@
+import os
+import json
+from importlib.util import find_spec
 from pymongo import MongoClient, version
 
 
+def available_compressors():
+    """
+    Wire compressors in order of preference, leaving out the ones whose
+    module is not installed (zlib ships with Python).
+    """
+    compressors = [name for name, module in (('zstd', 'zstandard'), ('snappy', 'snappy')) if find_spec(module)]
+    return ','.join(compressors + ['zlib'])
+
+
+# MongoClient options per workload. Loads want a big pool, compression and
+# plain w:1 acknowledgements; analytics read from secondaries when there are any.
+PROFILES = {
+    'default': {},
+    'bulk-load': {
+        'maxPoolSize': 64,
+        'compressors': available_compressors(),
+        'w': 1,
+        'journal': False,
+    },
+    'analytics': {
+        'maxPoolSize': 32,
+        'compressors': available_compressors(),
+        'readPreference': 'secondaryPreferred',
+    },
+}
+
+
 class DbConnector:
     """
     Connects to the MongoDB server on the Ubuntu virtual machine.
@@ -10,17 +40,34 @@ class DbConnector:
     HOST = "tdt4225-00.idi.ntnu.no" // Your server IP address/domain name
     USER = "testuser" // This is the user you created and added privileges for
     PASSWORD = "test123" // The password you set for said user
+
+    The environment overrides the arguments: MONGO_URI (a full connection
+    string), MONGO_HOST, MONGO_USER, MONGO_PASSWORD and MONGO_DATABASE.
+    The profile picks client options from PROFILES. Programs pass the one
+    for their workload, MONGO_PROFILE only applies when none is given.
+    MONGO_OPTIONS can add a JSON object of MongoClient options on top,
+    e.g. '{"maxPoolSize": 200, "w": 0}'.
     """
 
     def __init__(self,
                  DATABASE='db_group13_ex2',
                  HOST="tdt4225-59.idi.ntnu.no",
                  USER="user59",
-                 PASSWORD="user59"):
-        uri = "mongodb://%s:%s@%s/%s" % (USER, PASSWORD, HOST, DATABASE)
+                 PASSWORD="user59",
+                 profile=None,
+                 **options):
+        DATABASE = os.environ.get('MONGO_DATABASE', DATABASE)
+        HOST = os.environ.get('MONGO_HOST', HOST)
+        USER = os.environ.get('MONGO_USER', USER)
+        PASSWORD = os.environ.get('MONGO_PASSWORD', PASSWORD)
+        self.profile = profile or os.environ.get('MONGO_PROFILE', 'default')
+
+        uri = os.environ.get('MONGO_URI') or "mongodb://%s:%s@%s/%s" % (USER, PASSWORD, HOST, DATABASE)
+        client_options = {**PROFILES[self.profile], **options, **json.loads(os.environ.get('MONGO_OPTIONS', '{}'))}
+
         # Connect to the databases
         try:
-            self.client = MongoClient(uri)
+            self.client = MongoClient(uri, **client_options)
             self.db = self.client[DATABASE]
         except Exception as e:
             print("ERROR: Failed to connect to db:", e)
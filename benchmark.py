@@ -0,0 +1,352 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import subprocess
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from functools import partial
+import numpy as np
+from tabulate import tabulate
+import DbConnector as db_connector
+from task1 import Task_1_Program, PLT_EPOCH
+from task2 import Task_2_Program, REPORTS
+
+MODES = ('walk', 'bus', 'car', 'taxi', 'subway', 'train', 'bike', 'airplane')
+PLT_HEADER = ('Geolife trajectory', 'WGS 84', 'Altitude is in Feet', 'Reserved 3',
+              '0,2,255,My Track,0,0,2,8421376', '0')
+# Around the Forbidden City, so the geofence queries have something to find
+CENTER_LAT, CENTER_LON = 39.916, 116.397
+
+# Task 1 stages per loader, in the order main() runs them
+LOADERS = {
+    'single': ('insert_activities_and_trackpoints',),
+    'legacy': ('insert_activities', 'insert_trackpoints'),
+    'async': ('insert_async',),
+    'parallel': ('insert_parallel',),
+}
+
+
+def generate_dataset(base_dir, users=20, files_per_user=10, points_per_file=500, labeled_ratio=0.5,
+                     long_ratio=0.05, seed=0):
+    """
+    Writes a Geolife-shaped tree under base_dir: Data/<user>/Trajectory/*.plt,
+    Data/<user>/labels.txt for labeled users and labeled_ids.txt. The same
+    arguments always give byte-identical files. A long_ratio share of the
+    files is longer than the 2500 points Task 1 loads, a few points have the
+    -777 altitude and a few steps are gaps of more than 5 minutes.
+    Returns counts of what was written.
+    """
+    rng = random.Random(seed)
+    data_dir = os.path.join(base_dir, 'Data')
+    labeled_ids = []
+    stats = {'users': users, 'files': 0, 'points': 0, 'long_files': 0, 'labels': 0}
+
+    for user in range(users):
+        user_id = '%03d' % user
+        trajectory_dir = os.path.join(data_dir, user_id, 'Trajectory')
+        os.makedirs(trajectory_dir, exist_ok=True)
+        labeled = rng.random() < labeled_ratio
+        labels = []
+        start = datetime(2007, 4, 1) + timedelta(days=rng.randrange(5 * 365), seconds=rng.randrange(86400))
+
+        for _ in range(files_per_user):
+            if rng.random() < long_ratio:
+                point_count = rng.randint(2501, 4000)
+                stats['long_files'] += 1
+            else:
+                point_count = rng.randint(max(2, points_per_file // 2), max(2, points_per_file * 3 // 2))
+
+            end = write_plt(trajectory_dir, start, point_count, np.random.default_rng(rng.randrange(2 ** 32)))
+            if labeled and rng.random() < 0.8:
+                labels.append((start, end, rng.choice(MODES)))
+
+            stats['files'] += 1
+            stats['points'] += point_count
+            start = end + timedelta(hours=rng.randint(1, 72))
+
+        if labeled:
+            labeled_ids.append(user_id)
+            stats['labels'] += len(labels)
+            with open(os.path.join(data_dir, user_id, 'labels.txt'), 'w', newline='') as f:
+                f.write('Start Time\tEnd Time\tTransportation Mode\n')
+                for label_start, label_end, mode in labels:
+                    f.write(f"{label_start:%Y/%m/%d %H:%M:%S}\t{label_end:%Y/%m/%d %H:%M:%S}\t{mode}\n")
+
+    with open(os.path.join(base_dir, 'labeled_ids.txt'), 'w', newline='') as f:
+        f.write(''.join(user_id + '\n' for user_id in labeled_ids))
+
+    stats['labeled_users'] = len(labeled_ids)
+    stats['sample_user'] = labeled_ids[0] if labeled_ids else '000'
+    return stats
+
+
+def write_plt(trajectory_dir, start, point_count, rng):
+    """
+    One random walk as a .plt file named after its first timestamp.
+    Returns the timestamp of the last point.
+    """
+    steps = rng.choice([1, 2, 5, 10], size=point_count - 1, p=[0.4, 0.3, 0.2, 0.1])
+    steps[rng.random(point_count - 1) < 0.002] = 600
+    seconds = np.concatenate(([0], np.cumsum(steps)))
+    date_time = np.datetime64(start, 's') + seconds.astype('timedelta64[s]')
+    date_days = (date_time - PLT_EPOCH).astype('f8') / 86400
+
+    lat = CENTER_LAT + rng.normal(0, 0.05) + np.cumsum(rng.normal(0, 2e-5, point_count))
+    lon = CENTER_LON + rng.normal(0, 0.05) + np.cumsum(rng.normal(0, 2e-5, point_count))
+    altitude = np.round(150 + np.cumsum(rng.normal(0, 2, point_count)))
+    altitude[rng.random(point_count) < 0.01] = -777
+
+    stamps = date_time.astype(str)
+    lines = [f"{lat[i]:.6f},{lon[i]:.6f},0,{altitude[i]:.0f},{date_days[i]:.10f},{stamps[i][:10]},{stamps[i][11:]}"
+             for i in range(point_count)]
+
+    with open(os.path.join(trajectory_dir, f"{start:%Y%m%d%H%M%S}.plt"), 'w', newline='') as f:
+        f.write('\r\n'.join(PLT_HEADER + tuple(lines)) + '\r\n')
+
+    return date_time[-1].astype(datetime)
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process and its finished children so far.
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / scale
+
+
+def latency_stats(seconds):
+    milliseconds = np.asarray(seconds) * 1000
+    return {
+        'runs': len(milliseconds),
+        'mean_ms': float(milliseconds.mean()),
+        'min_ms': float(milliseconds.min()),
+        'p50_ms': float(np.percentile(milliseconds, 50)),
+        'p95_ms': float(np.percentile(milliseconds, 95)),
+    }
+
+
+def use_backend(backend):
+    """
+    'mongod' connects through DbConnector as usual, point MONGO_URI at a local
+    server. 'mongomock' swaps in an in-process mongomock client, shared by
+    every DbConnector so Task 2 sees what Task 1 loaded. mongomock lacks
+    $dateDiff, $geoWithin and pipeline $lookup, so some queries error there.
+    """
+    if backend == 'mongomock':
+        import mongomock
+        from mongomock.store import ServerStore
+        db_connector.MongoClient = partial(mongomock.MongoClient, _store=ServerStore())
+
+
+class Benchmark:
+    """
+    Times every Task 1 stage and every Task 2 report against one dataset.
+    Stage and query output is discarded so it does not skew the timings.
+    """
+
+    def __init__(self, base_dir, dataset, loader='single', repeat=5, task1_options=None):
+        self.base_dir = base_dir
+        self.data_dir = os.path.join(base_dir, 'Data')
+        self.dataset = dataset
+        self.loader = loader
+        self.repeat = repeat
+        self.task1_options = task1_options or {}
+
+    def run(self):
+        return {
+            'ingest': self.run_ingest(),
+            'queries': self.run_queries(),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+
+    def run_ingest(self):
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            program = Task_1_Program(**self.task1_options)
+            program.client.drop_database(program.db.name)
+
+        stages = [
+            ('create_collections', lambda: [program.create_coll(name) for name in ('User', 'Activity', 'TrackPoint')]),
+            ('insert_users', partial(program.insert_users, self.data_dir, os.path.join(self.base_dir, 'labeled_ids.txt'))),
+        ]
+        stages += [(name, partial(getattr(program, name), self.data_dir)) for name in LOADERS[self.loader]]
+        stages.append(('create_indexes', program.create_indexes))
+
+        results = {}
+        try:
+            for name, stage in stages:
+                with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                    start = time.perf_counter()
+                    stage()
+                    seconds = time.perf_counter() - start
+                results[name] = {'seconds': seconds, 'peak_rss_mb': peak_rss_mb()}
+
+            activities, points = self.loaded_counts(program.db)
+            load_seconds = sum(results[name]['seconds'] for name in LOADERS[self.loader])
+            results['total'] = {
+                'seconds': sum(result['seconds'] for result in results.values()),
+                'activities': activities,
+                'trackpoints': points,
+                'activities_per_s': activities / load_seconds,
+                'trackpoints_per_s': points / load_seconds,
+                'peak_rss_mb': peak_rss_mb(),
+            }
+        finally:
+            program.connection.client.close()
+
+        return results
+
+    def loaded_counts(self, db):
+        """
+        Activities and trackpoints actually loaded; files over 2500 points are skipped.
+        """
+        totals = list(db['Activity'].aggregate([
+            {"$group": {"_id": None, "activities": {"$sum": 1}, "points": {"$sum": "$point_count"}}}
+        ]))
+        if not totals:
+            return 0, 0
+        return totals[0]['activities'], totals[0]['points']
+
+    def queries(self):
+        # The default distance_walked user is not in a generated tree
+        params = {'distance_walked': {'user_id': self.dataset.get('sample_user', '112'), 'year': 2008, 'mode': 'walk'}}
+        return [(name, params.get(name, {})) for name in REPORTS]
+
+    def run_queries(self):
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            program = Task_2_Program(cache=False, verbose=False)
+
+        results = {}
+        try:
+            for name, params in self.queries():
+                results[name] = self.time_query(getattr(program, name), params)
+        finally:
+            program.connection.client.close()
+
+        return results
+
+    def time_query(self, method, params):
+        timings = []
+        try:
+            # One untimed run first, so the timings see warm caches on the server
+            method(**params)
+            for _ in range(self.repeat):
+                start = time.perf_counter()
+                method(**params)
+                timings.append(time.perf_counter() - start)
+        except Exception as e:
+            return {'runs': len(timings), 'error': f"{type(e).__name__}: {e}"}
+
+        return {**latency_stats(timings), 'error': None}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    ingest = [(name, round(stage['seconds'], 3), round(stage['peak_rss_mb'], 1))
+              for name, stage in results['ingest'].items()]
+    print(tabulate(ingest, headers=['Stage', 'Seconds', 'Peak RSS (MB)'], tablefmt="pretty"))
+
+    total = results['ingest']['total']
+    print(f"Loaded {total['activities']} activities ({total['activities_per_s']:.1f}/s), "
+          f"{total['trackpoints']} trackpoints ({total['trackpoints_per_s']:.0f}/s)")
+
+    queries = [(name, query.get('p50_ms') and round(query['p50_ms'], 2), query.get('p95_ms') and round(query['p95_ms'], 2),
+                query['error'] or '') for name, query in results['queries'].items()]
+    print(tabulate(queries, headers=['Query', 'p50 (ms)', 'p95 (ms)', 'Error'], tablefmt="pretty"))
+
+
+def compare(baseline, results):
+    """
+    Prints the current timings next to a baseline run, a ratio below 1 is faster.
+    """
+    rows = []
+    for name, stage in results['ingest'].items():
+        before = baseline['ingest'].get(name)
+        if before:
+            rows.append((name, before['seconds'] * 1000, stage['seconds'] * 1000))
+    for name, query in results['queries'].items():
+        before = baseline['queries'].get(name, {})
+        if query.get('p50_ms') and before.get('p50_ms'):
+            rows.append((name, before['p50_ms'], query['p50_ms']))
+
+    table = [(name, round(before, 2), round(after, 2), round(after / before, 2)) for name, before, after in rows]
+    print(tabulate(table, headers=['', 'Baseline (ms)', 'Current (ms)', 'Ratio'], tablefmt="pretty"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times Task 1 loading and Task 2 reports on a generated Geolife tree.")
+    parser.add_argument('--dataset-dir', default='benchmark_data')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--files-per-user', type=int, default=10)
+    parser.add_argument('--points-per-file', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', choices=('mongod', 'mongomock'), default='mongod')
+    parser.add_argument('--database', default='geolife_benchmark')
+    parser.add_argument('--loader', choices=sorted(LOADERS), default='single')
+    parser.add_argument('--layout', choices=('points', 'buckets'), default='points')
+    parser.add_argument('--timeseries', action='store_true')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', metavar='BASELINE_JSON')
+    args = parser.parse_args()
+
+    if args.backend == 'mongomock' and args.loader == 'parallel':
+        parser.error("the parallel loader needs a real mongod, worker processes can not share mongomock")
+    if args.loader == 'legacy' and args.layout == 'buckets':
+        parser.error("the legacy loader only writes the points layout")
+
+    # Never load into the assignment database
+    os.environ['MONGO_DATABASE'] = args.database
+    use_backend(args.backend)
+
+    scale = {'users': args.users, 'files_per_user': args.files_per_user,
+             'points_per_file': args.points_per_file, 'seed': args.seed}
+    dataset_dir = os.path.join(args.dataset_dir, '-'.join(f"{value}" for value in scale.values()))
+    start = time.perf_counter()
+    dataset = generate_dataset(dataset_dir, **scale)
+    print(f"Generated {dataset['files']} files, {dataset['points']} points in {time.perf_counter() - start:.1f}s")
+
+    task1_options = {'layout': args.layout, 'timeseries': args.timeseries, 'quiet': True}
+    benchmark = Benchmark(dataset_dir, dataset, loader=args.loader, repeat=args.repeat, task1_options=task1_options)
+    results = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'backend': args.backend,
+            'loader': args.loader,
+            'task1_options': task1_options,
+            'repeat': args.repeat,
+        },
+        'dataset': {**scale, **dataset},
+        **benchmark.run(),
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print_results(results)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import cProfile
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from pymongo import monitoring
+
+# Upper bounds in seconds, the same spread as the Prometheus client defaults plus the long tail of a full load
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def metric_key(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{label}="{value}"' for label, value in sorted(labels.items())) + '}'
+
+
+class Metrics:
+    """
+    Counters and latency histograms for one program, cheap enough to leave
+    on during a full load. Metrics are keyed by name plus optional labels,
+    e.g. observe('insert_seconds', 0.2, collection='TrackPoint'). With
+    profile_dir set, stages and timed methods are also captured with cProfile.
+    """
+
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.started = time.perf_counter()
+        # Loads write from several threads, see insert_async and ReportRunner
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.profiling = False
+
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def count(self, name, value=1, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.0,
+                                                    'count': 0, 'min': value, 'max': value}
+            histogram['buckets'][bisect_left(LATENCY_BUCKETS, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+            histogram['min'] = min(histogram['min'], value)
+            histogram['max'] = max(histogram['max'], value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def profile(self, name):
+        """
+        Runs the block under cProfile when profile_dir is set and dumps
+        <profile_dir>/<name>.prof. cProfile can not nest, so only the
+        outermost block is profiled.
+        """
+        with self.lock:
+            profiler = cProfile.Profile() if self.profile_dir and not self.profiling else None
+            self.profiling = self.profiling or profiler is not None
+
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{name}.prof"))
+                self.profiling = False
+
+    @contextmanager
+    def stage(self, name):
+        with self.profile(name), self.timer('stage_seconds', stage=name):
+            yield
+
+    def drain(self):
+        """
+        Returns the raw counters and histograms and starts over, so a pool
+        worker can hand its numbers to the parent after every task.
+        """
+        with self.lock:
+            state = {'counters': self.counters, 'histograms': self.histograms}
+            self.counters = {}
+            self.histograms = {}
+        return state
+
+    def merge(self, state):
+        with self.lock:
+            for key, value in state['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, other in state['histograms'].items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    self.histograms[key] = other
+                    continue
+                histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], other['buckets'])]
+                histogram['sum'] += other['sum']
+                histogram['count'] += other['count']
+                histogram['min'] = min(histogram['min'], other['min'])
+                histogram['max'] = max(histogram['max'], other['max'])
+
+    def quantile(self, histogram, q):
+        """
+        Upper bound of the bucket holding the q-th quantile, capped at the largest value seen.
+        """
+        rank = q * histogram['count']
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+            seen += count
+            if seen >= rank:
+                return min(bound, histogram['max'])
+        return histogram['max']
+
+    def to_dict(self):
+        elapsed = time.perf_counter() - self.started
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: dict(histogram) for key, histogram in self.histograms.items()}
+
+        return {
+            'elapsed_s': elapsed,
+            'counters': counters,
+            'rates_per_s': {key: value / elapsed for key, value in counters.items()},
+            'histograms': {
+                key: {
+                    'count': histogram['count'],
+                    'sum': histogram['sum'],
+                    'mean': histogram['sum'] / histogram['count'],
+                    'min': histogram['min'],
+                    'max': histogram['max'],
+                    'p50': self.quantile(histogram, 0.5),
+                    'p95': self.quantile(histogram, 0.95),
+                }
+                for key, histogram in histograms.items()
+            }
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix='geolife'):
+        """
+        The Prometheus text exposition format, counters get the _total suffix.
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(histogram)) for key, histogram in self.histograms.items())
+
+        typed = set()
+        for key, value in counters:
+            name, _, labels = key.partition('{')
+            name = f"{prefix}_{name}_total"
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{'{' + labels if labels else ''} {value}")
+
+        for key, histogram in histograms:
+            name, _, labels = key.partition('{')
+            name = f"{prefix}_{name}"
+            labels = labels.rstrip('}')
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            seen = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram['buckets']):
+                seen += count
+                bucket_labels = ','.join(filter(None, (labels, f'le="{bound}"')))
+                lines.append(f"{name}_bucket{{{bucket_labels}}} {seen}")
+            suffix = '{' + labels + '}' if labels else ''
+            lines.append(f"{name}_sum{suffix} {histogram['sum']}")
+            lines.append(f"{name}_count{suffix} {histogram['count']}")
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Writes the metrics to path, as Prometheus text for a .prom file and as JSON otherwise.
+        """
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus() if path.endswith('.prom') else self.to_json())
+
+
+def timed(name):
+    """
+    Method decorator recording every call into the histogram name of the
+    owner's metrics, labeled with the method name.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.profile(method.__name__), self.metrics.timer(name, method=method.__name__):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def stage(method):
+    """
+    Method decorator running the call as a Metrics.stage named after the method.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.metrics.stage(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class CommandLatencyListener(monitoring.CommandListener):
+    """
+    Feeds the latency of every MongoDB command into mongo_command_seconds,
+    labeled by command name. Pass it to MongoClient in event_listeners.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.metrics.observe('mongo_command_seconds', event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        self.metrics.observe('mongo_command_seconds', event.duration_micros / 1e6, command=event.command_name)
+        self.metrics.count('mongo_command_failures', command=event.command_name)
@@ -0,0 +1,330 @@
+import os
+import shutil
+import argparse
+from itertools import islice
+from pprint import pprint
+import numpy as np
+from trajectory import segment_distances_km, INVALID_ALTITUDE, FEET_TO_METERS
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # Only the Parquet export and the offline reports need it
+    pa = None
+
+ACTIVITY_FIELDS = ('transportation_mode', 'start_date_time', 'end_date_time', 'point_count',
+                   'distance_km', 'altitude_gain_m', 'max_gap_s', 'source_activity_id')
+TRACKPOINT_FIELDS = ('lat', 'lon', 'altitude')
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("The Parquet export and offline reports need pyarrow, pip install pyarrow")
+
+
+def schemas():
+    users = pa.schema([('user_id', pa.string()), ('is_labeled', pa.bool_())])
+    activities = pa.schema([
+        ('activity_id', pa.int64()),
+        ('transportation_mode', pa.string()),
+        ('start_date_time', pa.timestamp('ms')),
+        ('end_date_time', pa.timestamp('ms')),
+        ('point_count', pa.int64()),
+        ('distance_km', pa.float64()),
+        ('altitude_gain_m', pa.float64()),
+        ('max_gap_s', pa.float64()),
+        ('source_activity_id', pa.int64()),
+    ])
+    trackpoints = pa.schema([
+        ('activity_id', pa.int64()),
+        ('date_time', pa.timestamp('ms')),
+        ('lat', pa.float64()),
+        ('lon', pa.float64()),
+        ('altitude', pa.float64()),
+    ])
+    return users, activities, trackpoints
+
+
+def partitioning():
+    # Explicit types, inferring them would turn user '010' into the integer 10
+    return ds.partitioning(pa.schema([('user_id', pa.string()), ('year', pa.int32())]), flavor='hive')
+
+
+class PartitionWriter:
+    """
+    Appends rows to <root>/user_id=<user>/year=<year>/part-<n>.parquet with
+    one file open at a time, writing a row group every row_group_size rows.
+    Rows have to arrive grouped by partition, a partition seen again starts
+    a new part file.
+    """
+
+    def __init__(self, root, schema, row_group_size):
+        self.root = root
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.partition = None
+        self.writer = None
+        self.buffer = []
+        self.buffered = 0
+        self.parts = {}
+        self.rows = 0
+
+    def write(self, partition, columns):
+        if partition != self.partition:
+            self.close()
+            self.partition = partition
+
+        self.buffer.append(columns)
+        self.buffered += len(columns['activity_id'])
+        if self.buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        if self.writer is None:
+            user_id, year = self.partition
+            directory = os.path.join(self.root, f"user_id={user_id}", f"year={year}")
+            os.makedirs(directory, exist_ok=True)
+            part = self.parts.get(self.partition, 0)
+            self.parts[self.partition] = part + 1
+            self.writer = pq.ParquetWriter(os.path.join(directory, f"part-{part}.parquet"), self.schema)
+
+        table = pa.table({name: pa.array(np.concatenate([columns[name] for columns in self.buffer])
+                                         if isinstance(self.buffer[0][name], np.ndarray)
+                                         else [value for columns in self.buffer for value in columns[name]],
+                                         type=self.schema.field(name).type)
+                          for name in self.schema.names}, schema=self.schema)
+        self.writer.write_table(table)
+        self.rows += table.num_rows
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class ParquetExporter:
+    """
+    Dumps User, Activity and the trackpoints into Parquet under out_dir,
+    Activity and TrackPoint partitioned by user_id and the year the activity
+    started, for the offline reports. Activities are read with a batched
+    cursor sorted by user and start time and their points fetched
+    activities_per_query at a time through Task_2_Program.load_trackpoint_arrays,
+    so memory stays bounded and any TrackPoint layout works. Points are
+    written sorted by time within each activity.
+    """
+
+    def __init__(self, program, out_dir, activities_per_query=200, row_group_size=250000):
+        require_pyarrow()
+        self.program = program
+        self.db = program.db
+        self.out_dir = out_dir
+        self.activities_per_query = activities_per_query
+        self.row_group_size = row_group_size
+
+    def export(self):
+        user_schema, activity_schema, trackpoint_schema = schemas()
+        for table in ('User', 'Activity', 'TrackPoint'):
+            shutil.rmtree(os.path.join(self.out_dir, table), ignore_errors=True)
+
+        users = list(self.db['User'].find({}, {'is_labeled': 1}).sort('_id', 1))
+        os.makedirs(os.path.join(self.out_dir, 'User'))
+        pq.write_table(pa.table({'user_id': [user['_id'] for user in users],
+                                 'is_labeled': [bool(user.get('is_labeled')) for user in users]}, schema=user_schema),
+                       os.path.join(self.out_dir, 'User', 'part-0.parquet'))
+
+        activity_writer = PartitionWriter(os.path.join(self.out_dir, 'Activity'), activity_schema, self.row_group_size)
+        trackpoint_writer = PartitionWriter(os.path.join(self.out_dir, 'TrackPoint'), trackpoint_schema,
+                                            self.row_group_size)
+
+        projection = {'user_id': 1, **{field: 1 for field in ACTIVITY_FIELDS}}
+        cursor = self.db['Activity'].find({}, projection).sort([('user_id', 1), ('start_date_time', 1)])
+        cursor = cursor.batch_size(self.activities_per_query)
+
+        try:
+            while True:
+                chunk = list(islice(cursor, self.activities_per_query))
+                if not chunk:
+                    break
+
+                points = dict(self.program.load_trackpoint_arrays([activity['_id'] for activity in chunk],
+                                                                  TRACKPOINT_FIELDS))
+                for activity in chunk:
+                    partition = (activity['user_id'], activity['start_date_time'].year)
+                    activity_writer.write(partition, {
+                        'activity_id': [activity['_id']],
+                        **{field: [activity.get(field)] for field in ACTIVITY_FIELDS}
+                    })
+
+                    columns = points.get(activity['_id'])
+                    if columns is not None and len(columns['date_time']):
+                        trackpoint_writer.write(partition, {
+                            'activity_id': np.full(len(columns['date_time']), activity['_id'], dtype='int64'),
+                            'date_time': columns['date_time'].astype('datetime64[ms]'),
+                            **{field: np.asarray(columns[field], dtype='f8') for field in TRACKPOINT_FIELDS}
+                        })
+        finally:
+            activity_writer.close()
+            trackpoint_writer.close()
+
+        print(f"Exported {len(users)} users, {activity_writer.rows} activities and "
+              f"{trackpoint_writer.rows} trackpoints to {self.out_dir}")
+        return len(users), activity_writer.rows, trackpoint_writer.rows
+
+
+class OfflineReports:
+    """
+    The Task 2 reports answered from a ParquetExporter export with
+    vectorized scans, no database needed. Method names, parameters and
+    return values follow Task_2_Program, so ReportRunner can run them too.
+    Trackpoint scans go one partition file at a time.
+    """
+
+    def __init__(self, data_dir):
+        require_pyarrow()
+        self.users = ds.dataset(os.path.join(data_dir, 'User'), format='parquet')
+        self.activities = ds.dataset(os.path.join(data_dir, 'Activity'), format='parquet', partitioning=partitioning())
+        self.trackpoints = ds.dataset(os.path.join(data_dir, 'TrackPoint'), format='parquet',
+                                      partitioning=partitioning())
+
+    def _activity_columns(self, columns, filter=None):
+        table = self.activities.to_table(columns=list(columns), filter=filter)
+        return {name: table[name].to_numpy(zero_copy_only=False) for name in columns}
+
+    def _scan_trackpoints(self, columns, filter=None):
+        """
+        Yields (user_id, year, columns) per trackpoint file. An activity never
+        spans two files and its points are stored in time order.
+        """
+        for fragment in self.trackpoints.get_fragments(filter=filter):
+            keys = ds.get_partition_keys(fragment.partition_expression)
+            table = fragment.to_table(columns=list(columns), filter=filter, schema=self.trackpoints.schema)
+            yield keys['user_id'], keys['year'], {name: table[name].to_numpy() for name in columns}
+
+    def _same_activity(self, activity_ids):
+        # True where a point and the one before it belong to the same activity
+        return activity_ids[1:] == activity_ids[:-1]
+
+    def count_users_activities_trackpoints(self):
+        return self.users.count_rows(), self.activities.count_rows(), self.trackpoints.count_rows()
+
+    def avg_activities_per_user(self):
+        user_count, activity_count, _ = self.count_users_activities_trackpoints()
+        return activity_count / user_count if user_count > 0 else 0
+
+    def top_20_users_with_most_activities(self):
+        user_ids, counts = np.unique(self._activity_columns(['user_id'])['user_id'], return_counts=True)
+        order = np.argsort(-counts, kind='stable')[:20]
+        return [{'_id': user_ids[i], 'activity_count': int(counts[i])} for i in order]
+
+    def find_taxi_users(self, mode='taxi'):
+        user_ids = self._activity_columns(['user_id'], ds.field('transportation_mode') == mode)['user_id']
+        return np.unique(user_ids).tolist()
+
+    def count_transportation_modes(self):
+        modes = self._activity_columns(['transportation_mode'], ds.field('transportation_mode').is_valid())
+        modes, counts = np.unique(modes['transportation_mode'].astype(str), return_counts=True)
+        order = np.argsort(-counts, kind='stable')
+        return [{'_id': str(modes[i]), 'mode_count': int(counts[i])} for i in order]
+
+    def find_year_with_most_activities_and_hours(self):
+        columns = self._activity_columns(['year', 'start_date_time', 'end_date_time'])
+        if not len(columns['year']):
+            return None
+
+        years, counts = np.unique(columns['year'], return_counts=True)
+        # Hour boundaries crossed, what $dateDiff with unit 'hour' counts
+        hours = (columns['end_date_time'].astype('datetime64[h]')
+                 - columns['start_date_time'].astype('datetime64[h]')).astype('int64')
+        total_hours = np.bincount(np.searchsorted(years, columns['year']), weights=hours, minlength=len(years))
+
+        return {
+            'activity_year': int(years[counts.argmax()]),
+            'activity_count': int(counts.max()),
+            'hours_year': int(years[total_hours.argmax()]),
+            'total_hours': float(total_hours.max())
+        }
+
+    def distance_walked(self, user_id="112", year=2008, mode="walk"):
+        activity_ids = self._activity_columns(['activity_id'], (ds.field('user_id') == user_id)
+                                              & (ds.field('year') == year)
+                                              & (ds.field('transportation_mode') == mode))['activity_id']
+        if not len(activity_ids):
+            return 0
+
+        total_distance = 0.0
+        point_filter = ((ds.field('user_id') == user_id) & (ds.field('year') == year)
+                        & ds.field('activity_id').isin(activity_ids))
+        for _, _, points in self._scan_trackpoints(('activity_id', 'lat', 'lon'), point_filter):
+            distances = segment_distances_km(points['lat'], points['lon'])
+            total_distance += float(distances[self._same_activity(points['activity_id'])].sum())
+        return total_distance
+
+    def get_most_used_transportation_mode(self):
+        columns = self._activity_columns(['user_id', 'transportation_mode'], ds.field('transportation_mode').is_valid())
+        pairs, counts = np.unique(np.char.add(np.char.add(columns['user_id'].astype(str), '\t'),
+                                              columns['transportation_mode'].astype(str)), return_counts=True)
+
+        most_used_modes = {}
+        for pair, count in zip(pairs, counts):
+            user_id, mode = pair.split('\t')
+            if count > most_used_modes.get(user_id, (None, 0))[1]:
+                most_used_modes[user_id] = (mode, count)
+        return {user_id: mode for user_id, (mode, _) in most_used_modes.items()}
+
+    def top_20_users_by_altitude_gain(self):
+        user_altitude_gain = {}
+        for user_id, _, points in self._scan_trackpoints(('activity_id', 'altitude')):
+            altitude = points['altitude']
+            steps = np.diff(altitude)
+            gains = self._same_activity(points['activity_id']) & (altitude[1:] != INVALID_ALTITUDE) & (steps > 0)
+            user_altitude_gain[user_id] = user_altitude_gain.get(user_id, 0.0) + float(steps[gains].sum() * FEET_TO_METERS)
+
+        gains = [(user_id, gain) for user_id, gain in user_altitude_gain.items() if gain > 0]
+        return sorted(gains, key=lambda x: x[1], reverse=True)[:20]
+
+    def find_users_with_invalid_activities(self):
+        invalid_activities_per_user = {}
+        for user_id, _, points in self._scan_trackpoints(('activity_id', 'date_time')):
+            gaps = np.diff(points['date_time'].astype('datetime64[ms]').astype('int64'))
+            invalid = self._same_activity(points['activity_id']) & (gaps >= 5 * 60 * 1000)
+            count = len(np.unique(points['activity_id'][1:][invalid]))
+            if count:
+                invalid_activities_per_user[user_id] = invalid_activities_per_user.get(user_id, 0) + count
+        return invalid_activities_per_user
+
+    def find_users_in_forbidden_city(self, forbidden_city_lat=39.916, forbidden_city_lon=116.397, tolerance=0.001):
+        box = ((ds.field('lat') >= forbidden_city_lat) & (ds.field('lat') <= forbidden_city_lat + tolerance)
+               & (ds.field('lon') >= forbidden_city_lon) & (ds.field('lon') <= forbidden_city_lon + tolerance))
+        return set(self.trackpoints.to_table(columns=['user_id'], filter=box)['user_id'].unique().to_pylist())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports the database to Parquet and runs the Task 2 reports on it offline.")
+    parser.add_argument('command', choices=('export', 'reports'))
+    parser.add_argument('data_dir')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        from task2 import Task_2_Program
+        program = Task_2_Program(cache=False, verbose=False)
+        try:
+            ParquetExporter(program, args.data_dir).export()
+        finally:
+            program.connection.close_connection()
+    else:
+        from task2 import ReportRunner, REPORTS
+        results = ReportRunner(OfflineReports(args.data_dir), max_workers=1).run(REPORTS)
+        for name, result in results.items():
+            print(f"\n{name} ({result['seconds']:.3f}s)")
+            pprint(result['error'] or result['result'])
+
+
+if __name__ == '__main__':
+    main()
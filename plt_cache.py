@@ -0,0 +1,68 @@
+import os
+import hashlib
+import numpy as np
+
+# One row per .plt point, the columns parse_plt works with
+CACHE_DTYPE = np.dtype([('lat', '<f8'), ('lon', '<f8'), ('altitude', '<f8'), ('date_days', '<f8'),
+                        ('date_time', '<M8[s]')])
+
+
+class PltCache:
+    """
+    Parsed .plt files as .npy arrays on local disk, so reloading the same
+    Geolife tree skips the text parsing. An entry is keyed by the source
+    path and only valid for the mtime and size the file had when it was
+    converted. Entries are opened memory-mapped: the columns handed out
+    are views into the page cache, nothing is copied or parsed.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _prefix(self, file_path):
+        return hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()[:20]
+
+    def path(self, file_path):
+        stat = os.stat(file_path)
+        prefix = self._prefix(file_path)
+        # Sharded by prefix, so cleaning up old versions lists a small directory
+        return os.path.join(self.cache_dir, prefix[:2], f"{prefix}-{stat.st_mtime_ns}-{stat.st_size}.npy")
+
+    def load(self, file_path):
+        """
+        The cached rows of file_path as a read-only memory-mapped structured
+        array, or None if there is no entry for its current mtime and size.
+        """
+        try:
+            return np.load(self.path(file_path), mmap_mode='r')
+        except FileNotFoundError:
+            return None
+
+    def columns(self, rows, start=0, stop=None):
+        return {name: rows[name][start:stop] for name in CACHE_DTYPE.names}
+
+    def store(self, file_path, columns):
+        """
+        Writes the parsed columns of file_path and drops entries for older versions of the file.
+        """
+        path = self.path(file_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        rows = np.empty(len(columns['lat']), dtype=CACHE_DTYPE)
+        for name in CACHE_DTYPE.names:
+            rows[name] = columns[name]
+
+        # Write then rename, a crash never leaves a truncated entry behind
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, rows)
+        os.replace(tmp_path, path)
+
+        shard_dir, current = os.path.split(path)
+        prefix = self._prefix(file_path) + '-'
+        for file_name in os.listdir(shard_dir):
+            if file_name.startswith(prefix) and file_name.endswith('.npy') and file_name != current:
+                os.remove(os.path.join(shard_dir, file_name))
+
+    def is_valid(self, file_path):
+        return os.path.exists(self.path(file_path))
@@ -0,0 +1,145 @@
+import os
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Ingestion bumps this counter, cached query results from an older version are ignored
+DATA_VERSION_ID = 'data_version'
+
+
+def read_data_version(db):
+    doc = db['DataVersion'].find_one({'_id': DATA_VERSION_ID})
+    return doc['version'] if doc else 0
+
+
+def bump_data_version(db):
+    db['DataVersion'].update_one({'_id': DATA_VERSION_ID}, {'$inc': {'version': 1}}, upsert=True)
+
+
+class QueryCache:
+    """
+    Results of report queries keyed by method, parameters and data version.
+    An in-memory LRU in front of an optional on-disk tier of pickle files,
+    both expiring entries after ttl seconds. Entries of older data versions
+    can never be hit again, they are dropped as soon as a newer version shows up.
+    """
+
+    def __init__(self, max_entries=256, ttl=3600, cache_dir=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        # Reports may run concurrently, see ReportRunner
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.version = None
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, method, params, version):
+        return f"{method}|{sorted(params.items())!r}|v{version}"
+
+    def get_or_compute(self, method, params, version, compute):
+        if version != self.version:
+            self.sweep(version)
+
+        key = self.key(method, params, version)
+        found, value = self.get(key, version)
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if found:
+            return value
+
+        value = compute()
+        self.set(key, value, version)
+        return value
+
+    def sweep(self, version):
+        """
+        Drops the entries of every other data version and, on disk, the expired files.
+        """
+        with self.lock:
+            self.version = version
+            suffix = f"|v{version}"
+            for key in [key for key in self.entries if not key.endswith(suffix)]:
+                del self.entries[key]
+
+        if self.cache_dir:
+            prefix = f"v{version}-"
+            expired = time.time() - self.ttl
+            for file_name in os.listdir(self.cache_dir):
+                if not file_name.endswith('.pkl'):
+                    continue
+                path = os.path.join(self.cache_dir, file_name)
+                try:
+                    # A file is written with its entry, so its mtime tells when it expires
+                    if not file_name.startswith(prefix) or os.path.getmtime(path) < expired:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def get(self, key, version):
+        now = time.time()
+
+        with self.lock:
+            if key in self.entries:
+                expires, value = self.entries[key]
+                if expires > now:
+                    self.entries.move_to_end(key)
+                    return True, value
+                del self.entries[key]
+
+        if self.cache_dir:
+            path = self._path(key, version)
+            if os.path.exists(path):
+                try:
+                    with open(path, 'rb') as f:
+                        expires, value = pickle.load(f)
+                except (OSError, pickle.UnpicklingError, EOFError):
+                    return False, None
+                if expires > now:
+                    self._remember(key, expires, value)
+                    return True, value
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+        return False, None
+
+    def set(self, key, value, version):
+        expires = time.time() + self.ttl
+        self._remember(key, expires, value)
+
+        if self.cache_dir:
+            # Write then rename, so a concurrent reader never sees half a file
+            path = self._path(key, version)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((expires, value), f)
+            os.replace(tmp_path, path)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        if self.cache_dir:
+            for file_name in os.listdir(self.cache_dir):
+                if file_name.endswith('.pkl'):
+                    os.remove(os.path.join(self.cache_dir, file_name))
+
+    def _remember(self, key, expires, value):
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _path(self, key, version):
+        return os.path.join(self.cache_dir, f"v{version}-{hashlib.sha1(key.encode()).hexdigest()}.pkl")
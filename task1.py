@@ -2,19 +2,220 @@ from pprint import pprint
 from DbConnector import DbConnector
 import os
 from datetime import datetime
+from collections import defaultdict
+from bson import ObjectId
+from pymongo import ReplaceOne, UpdateOne, WriteConcern
+from pymongo.errors import CollectionInvalid
+from multiprocessing import Pool, util
+from tabulate import tabulate
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_right
+from itertools import accumulate, islice
+import numpy as np
+from trajectory import encode_bucket_columns, activity_metrics, simplify_mask
+from query_cache import bump_data_version
+from metrics import Metrics, CommandLatencyListener, stage
+from plt_cache import PltCache
+
+# Columns 0, 1, 3, 4, 5 and 6 of a .plt line; column 2 is always 0
+PLT_DTYPE = [('lat', 'f8'), ('lon', 'f8'), ('altitude', 'f8'), ('date_days', 'f8'),
+             ('date', 'U10'), ('time', 'U8')]
+# date_days counts days since this date
+PLT_EPOCH = np.datetime64('1899-12-30T00:00:00', 's')
+# TrackPoint fields stored in the metaField of a time-series TrackPoint
+TIMESERIES_META_FIELDS = ('activity_id', 'user_id', 'transportation_mode')
+# Segments of a split .plt file take the ids base_id * 100 + segment
+MAX_SEGMENTS = 100
+ROLLUP_PROJECTION = {'user_id': 1, 'transportation_mode': 1, 'start_date_time': 1, 'end_date_time': 1, 'distance_km': 1}
+
+class LabelIndex:
+    """
+    A user's labels.txt entries, keyed by exact (start, end) and also kept
+    sorted by start time, so 'contain' and 'overlap' matches are a binary
+    search instead of a scan over every label.
+    """
+
+    def __init__(self, labels=()):
+        self.exact = {(start, end): mode for start, end, mode in labels}
+        self.intervals = sorted((start, end, mode) for (start, end), mode in self.exact.items())
+        self.starts = [start for start, _, _ in self.intervals]
+        # Running maximum of the end times, lets the backwards scans stop early
+        self.max_ends = list(accumulate((end for _, end, _ in self.intervals), max))
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def match(self, start, end, how='exact'):
+        """
+        Returns the transportation mode for an activity, or None.
+        how='exact' needs identical start and end, 'contain' takes a label
+        covering the whole activity and 'overlap' the label overlapping it most.
+        """
+        if how == 'exact':
+            return self.exact.get((start, end))
+
+        if how == 'contain':
+            i = bisect_right(self.starts, start) - 1
+            while i >= 0 and self.max_ends[i] >= end:
+                if self.intervals[i][1] >= end:
+                    return self.intervals[i][2]
+                i -= 1
+            return None
+
+        if how == 'overlap':
+            best_mode, best_overlap = None, None
+            i = bisect_right(self.starts, end) - 1
+            while i >= 0 and self.max_ends[i] >= start:
+                label_start, label_end, mode = self.intervals[i]
+                if label_end >= start:
+                    overlap = min(label_end, end) - max(label_start, start)
+                    if best_overlap is None or overlap >= best_overlap:
+                        best_mode, best_overlap = mode, overlap
+                i -= 1
+            return best_mode
+
+        raise ValueError(f"Unknown label matching mode: {how}")
+
+
+def activity_hours(start, end):
+    """
+    Hour boundaries crossed between start and end, the same count as
+    $dateDiff with unit 'hour'.
+    """
+    start_hour = start.replace(minute=0, second=0, microsecond=0)
+    end_hour = end.replace(minute=0, second=0, microsecond=0)
+    return int((end_hour - start_hour).total_seconds() // 3600)
+
+
+class IngestCheckpoint:
+    """
+    Append-only journal of the .plt files that are fully loaded, keyed by
+    (user_id, file name) and stamped with the file's mtime and size, so an
+    interrupted or nightly load only has to redo new or changed files.
+    Entries also record the long trajectory policy (max_points and
+    long_trajectories) they were loaded under, a file loaded under another
+    policy is not done. Entries from before the policy was recorded were
+    loaded with the old fixed cap, skipping files over 2500 points.
+    """
+
+    def __init__(self, path, policy=(2500, 'skip')):
+        self.path = path
+        self.policy = list(policy)
+        self.done = {}
+        # Loaded under another policy, possibly as split segments
+        self.other_policy = set()
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        key = (entry['user_id'], entry['file'])
+                        if entry.get('policy', [2500, 'skip']) == self.policy:
+                            self.done[key] = (entry['mtime'], entry['size'])
+                            self.other_policy.discard(key)
+                        else:
+                            self.done.pop(key, None)
+                            self.other_policy.add(key)
+
+    def file_stamp(self, file_path):
+        stat = os.stat(file_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def is_done(self, user_id, file_path):
+        key = (user_id, os.path.basename(file_path))
+        return self.done.get(key) == self.file_stamp(file_path)
+
+    def loaded_under_other_policy(self, user_id, file_path):
+        return (user_id, os.path.basename(file_path)) in self.other_policy
+
+    def record(self, user_id, file_paths):
+        with open(self.path, 'a') as f:
+            for file_path in file_paths:
+                mtime, size = self.file_stamp(file_path)
+                file_name = os.path.basename(file_path)
+                f.write(json.dumps({'user_id': user_id, 'file': file_name, 'mtime': mtime, 'size': size,
+                                    'policy': self.policy}) + '\n')
+                self.done[(user_id, file_name)] = (mtime, size)
+                self.other_policy.discard((user_id, file_name))
+
 
 class Task_1_Program:
 
-    def __init__(self):
-        self.connection = DbConnector()
+    def __init__(self, parser='numpy', timestamps='strings', label_match='exact', geo=False,
+                 denormalize=False, checkpoint=None, timeseries=False, layout='points',
+                 bucket_size=1000, rollups=True, quiet=False, profile_dir=None, max_points=2500,
+                 long_trajectories='skip', plt_cache=None, simplify_tolerance_m=None, simplify_min_step_s=None):
+        self.metrics = Metrics(profile_dir)
+        self.connection = DbConnector(profile='bulk-load', event_listeners=[CommandLatencyListener(self.metrics)])
         self.client = self.connection.client
         self.db = self.connection.db
+        # Passed on to the workers of insert_parallel
+        self.options = {
+            'parser': parser,
+            'timestamps': timestamps,
+            'label_match': label_match,
+            'geo': geo,
+            'denormalize': denormalize,
+            'checkpoint': checkpoint,
+            'timeseries': timeseries,
+            'layout': layout,
+            'bucket_size': bucket_size,
+            'rollups': rollups,
+            'quiet': quiet,
+            'max_points': max_points,
+            'long_trajectories': long_trajectories,
+            'plt_cache': plt_cache,
+            'simplify_tolerance_m': simplify_tolerance_m,
+            'simplify_min_step_s': simplify_min_step_s
+        }
+        self.checkpoint = IngestCheckpoint(checkpoint, (max_points, long_trajectories)) if checkpoint else None
+        self.plt_cache = PltCache(plt_cache) if plt_cache else None
+
+    def log(self, *args):
+        # Per-file and per-user progress, printing it costs real time on a full load
+        if not self.options['quiet']:
+            print(*args)
 
     def create_coll(self, collection_name):
-        collection = self.db.create_collection(collection_name)    
-        print('Created collection: ', collection)
+        options = {}
+        if collection_name == 'TrackPoint' and self.options['timeseries']:
+            options['timeseries'] = {'timeField': 'date_time', 'metaField': 'meta', 'granularity': 'seconds'}
+
+        try:
+            collection = self.db.create_collection(collection_name, **options)    
+            print('Created collection: ', collection)
+        except CollectionInvalid:
+            if options:
+                # Time-series points in a plain collection would sit under meta where Task_2 never looks
+                info = next(self.db.list_collections(filter={'name': collection_name}), None)
+                if info is None or 'timeseries' not in info.get('options', {}):
+                    raise ValueError(f"{collection_name} already exists as a plain collection, "
+                                     "drop it before loading with timeseries=True")
+            print('Collection already exists: ', collection_name)
+
 
+    def tp_field(self, name):
+        """
+        Path of a TrackPoint field. In a time-series TrackPoint the activity
+        and user fields live under the 'meta' metaField.
+        """
+        if self.options['timeseries'] and self.options['layout'] == 'points' and name in TIMESERIES_META_FIELDS:
+            return 'meta.' + name
+        return name
 
+
+    def point_collection(self):
+        """
+        Where the points go: one TrackPoint per fix, or with layout='buckets'
+        one TrajectoryBucket per bucket_size points of an activity.
+        """
+        return 'TrajectoryBucket' if self.options['layout'] == 'buckets' else 'TrackPoint'
+
+
+    @stage
     def insert_users(self, base_dir, labeled_ids_file):
         with open(labeled_ids_file, 'r') as f:
             labeled_ids = {line.strip() for line in f}
@@ -36,133 +237,727 @@ class Task_1_Program:
                 })
         
         if user_docs:
-            self.db['User'].insert_many(user_docs)
+            self.db['User'].bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in user_docs])
             print(f"Inserted {len(user_docs)} users.")
+            bump_data_version(self.db)
 
 
-    def insert_activities(self, base_dir):
+    def user_dirs(self, base_dir):
         for root, dirs, files in os.walk(base_dir):
             if 'Trajectory' in dirs:
-                user_id = os.path.basename(root)
-                labels = {}
-                labels_file_path = os.path.join(root, 'labels.txt')
-                
-                if os.path.exists(labels_file_path):
-                    with open(labels_file_path, 'r') as f:
-                        f.readline()  # Skip header line
-                        for line in f:
-                            start_time_str, end_time_str, transportation_mode = line.strip().split('\t')
-                            start_time = datetime.strptime(start_time_str, "%Y/%m/%d %H:%M:%S")
-                            end_time = datetime.strptime(end_time_str, "%Y/%m/%d %H:%M:%S")
-                            labels[(start_time, end_time)] = transportation_mode
-
-                trajectory_folder = os.path.join(root, 'Trajectory')
-                activity_docs = []
+                yield os.path.basename(root), root
 
-                for plt_file in os.listdir(trajectory_folder):
-                    if plt_file.endswith(".plt"):
-                        file_path = os.path.join(trajectory_folder, plt_file)
-                        with open(file_path, 'r') as file:
-                            lines = file.readlines()
-                            line_count = len(lines)
-
-                            if line_count - 6 <= 2500:
-                                start_time = lines[6].strip().split(',')[6]
-                                start_date = lines[6].strip().split(',')[5]
-                                end_time = lines[-1].strip().split(',')[6]
-                                end_date = lines[-1].strip().split(',')[5]
-                                start_date_time = start_date + ' ' + start_time
-                                end_date_time = end_date + ' ' + end_time
-                                start_date_time = datetime.strptime(start_date_time, "%Y-%m-%d %H:%M:%S")
-                                end_date_time = datetime.strptime(end_date_time, "%Y-%m-%d %H:%M:%S")
-
-                                transportation_mode = None
-                                for (label_start, label_end), mode in labels.items():
-                                    if label_start == start_date_time and label_end == end_date_time:
-                                        transportation_mode = mode
-                                        break
-                                
-                                activity_docs.append({
-                                    "_id": int(plt_file.split('.')[0] + user_id),  
-                                    "user_id": user_id,
-                                    "transportation_mode": transportation_mode,
-                                    "start_date_time": start_date_time,
-                                    "end_date_time": end_date_time,
-                                    "trackpoint_ids": [] 
-                                })
-                
-                if activity_docs:
-                    self.db['Activity'].insert_many(activity_docs)
-                    print(f"Inserted {len(activity_docs)} activities for user {user_id}.")
 
+    def read_labels(self, root):
+        labels = []
+        labels_file_path = os.path.join(root, 'labels.txt')
+
+        if os.path.exists(labels_file_path):
+            with open(labels_file_path, 'r') as f:
+                f.readline()  # Skip header line
+                for line in f:
+                    start_time_str, end_time_str, transportation_mode = line.strip().split('\t')
+                    start_time = datetime.strptime(start_time_str, "%Y/%m/%d %H:%M:%S")
+                    end_time = datetime.strptime(end_time_str, "%Y/%m/%d %H:%M:%S")
+                    labels.append((start_time, end_time, transportation_mode))
+
+        return LabelIndex(labels)
+
+
+    def plt_files(self, root):
+        trajectory_folder = os.path.join(root, 'Trajectory')
+        for plt_file in os.listdir(trajectory_folder):
+            if plt_file.endswith(".plt"):
+                yield plt_file, os.path.join(trajectory_folder, plt_file)
+
+
+    def parse_plt_text(self, lines):
+        columns = {'lat': [], 'lon': [], 'altitude': [], 'date_days': [], 'date_time': []}
+
+        for line in lines:
+            data = line.strip().split(',')
+            date_time_str = data[5] + ' ' + data[6]
+            columns['lat'].append(float(data[0]))
+            columns['lon'].append(float(data[1]))
+            columns['altitude'].append(float(data[3]))
+            columns['date_days'].append(float(data[4]))
+            columns['date_time'].append(datetime.strptime(date_time_str, "%Y-%m-%d %H:%M:%S"))
+
+        columns = {name: np.array(values) for name, values in columns.items()}
+        columns['date_time'] = columns['date_time'].astype('datetime64[s]')
+        return columns
+
+
+    def parse_plt_arrays(self, lines, timestamps='strings'):
+        """
+        Vectorized counterpart of parse_plt_text. With timestamps='days' the
+        date_time column is derived from date_days, skipping the date strings.
+        """
+        if timestamps == 'days':
+            dtype = PLT_DTYPE[:4]
+            usecols = (0, 1, 3, 4)
+        else:
+            dtype = PLT_DTYPE
+            usecols = (0, 1, 3, 4, 5, 6)
+
+        rows = np.loadtxt(lines, delimiter=',', usecols=usecols, dtype=dtype, ndmin=1)
+
+        if timestamps == 'days':
+            seconds = np.rint(rows['date_days'] * 86400).astype('int64')
+            date_time = PLT_EPOCH + seconds.astype('timedelta64[s]')
+        else:
+            date_time = np.char.add(np.char.add(rows['date'], 'T'), rows['time']).astype('datetime64[s]')
+
+        return {
+            'lat': rows['lat'],
+            'lon': rows['lon'],
+            'altitude': rows['altitude'],
+            'date_days': rows['date_days'],
+            'date_time': date_time
+        }
+
+
+    def read_plt_chunks(self, file_path, chunk_size):
+        """
+        Streams the points of a .plt file as columns of at most chunk_size
+        points, from the plt_cache when it has a valid entry for the file.
+        """
+        if self.plt_cache:
+            rows = self.plt_cache.load(file_path)
+            if rows is not None:
+                self.metrics.count('plt_cache_hits')
+                for start in range(0, len(rows), chunk_size):
+                    yield self.plt_cache.columns(rows, start, start + chunk_size)
+                return
+            self.metrics.count('plt_cache_misses')
+
+        yield from self.parse_plt_chunks(file_path, chunk_size)
+
+
+    def parse_plt_chunks(self, file_path, chunk_size):
+        """
+        Parses a .plt file chunk by chunk. Only one chunk of lines is held at
+        a time, so memory stays flat however long the file is.
+        """
+        with open(file_path, 'r') as file:
+            for _ in range(6):  # Skip header lines
+                file.readline()
+
+            while True:
+                chunk = list(islice(file, chunk_size))
+                if not chunk:
+                    return
+                lines = [line for line in chunk if line.strip()]
+                if not lines:
+                    continue
+
+                # Timed apart from the yield, the caller's work on the chunk is not parsing
+                with self.metrics.timer('parse_seconds'):
+                    if self.options['parser'] == 'text':
+                        columns = self.parse_plt_text(lines)
+                    else:
+                        columns = self.parse_plt_arrays(lines, self.options['timestamps'])
+                yield columns
+
+
+    def read_plt(self, file_path):
+        """
+        The points of a .plt file as one or more column segments, following
+        the long_trajectories policy for files with more than max_points
+        points: 'skip' yields nothing, 'split' yields segments of max_points.
+        max_points=None loads every file whole.
+        """
+        max_points = self.options['max_points']
+
+        if max_points and self.options['long_trajectories'] == 'split':
+            yield from self.read_plt_chunks(file_path, max_points)
+            return
+
+        chunks = []
+        point_count = 0
+        for chunk in self.read_plt_chunks(file_path, max_points + 1 if max_points else 10000):
+            chunks.append(chunk)
+            point_count += len(chunk['lat'])
+            if max_points and point_count > max_points:
+                self.metrics.count('files_too_long')
+                return
+
+        if chunks:
+            yield chunks[0] if len(chunks) == 1 else {name: np.concatenate([chunk[name] for chunk in chunks])
+                                                      for name in chunks[0]}
+
+
+    @stage
+    def convert_plt_files(self, base_dir):
+        """
+        Parses every .plt file under base_dir once into the plt_cache, later
+        loads of the tree read the cached arrays instead of the text. Files
+        with a valid entry are left alone, so this is cheap to rerun.
+        """
+        converted = 0
+        cached = 0
+
+        for user_id, root in self.user_dirs(base_dir):
+            for file_name, file_path in self.plt_files(root):
+                if self.plt_cache.is_valid(file_path):
+                    cached += 1
+                    continue
+
+                chunks = list(self.parse_plt_chunks(file_path, 10000))
+                columns = {name: np.concatenate([chunk[name] for chunk in chunks]) if chunks else np.empty(0)
+                           for name in ('lat', 'lon', 'altitude', 'date_days', 'date_time')}
+                self.plt_cache.store(file_path, columns)
+                converted += 1
+
+        print(f"Converted {converted} .plt files, {cached} were already cached.")
+        return converted
+
+
+    def parse_plt(self, file_path, user_id, labels, count=True):
+        """
+        Reads a .plt file once and yields (activity_doc, columns) for each of
+        its activities: none if the file is empty or skipped as too long, one
+        normally, and one per segment when a long file is split. columns holds
+        the points as NumPy arrays; TrackPoint documents are only built from them
+        by trackpoint_docs right before insert. TrackPoint ids are generated here
+        so the Activity can reference them before anything is written.
+
+        The segments of a split file get the ids base_id * 100 + segment and
+        keep base_id in source_activity_id. An exact label match is checked
+        as 'contain' for them, a label matching the whole file covers each segment.
+
+        count=False leaves the parse counters alone, for a pass over files
+        that another stage of the same load parses and counts again.
+        """
+        metrics = self.metrics if count else Metrics()
+        base_id = self.activity_id(file_path, user_id)
+        segments = self.read_plt(file_path)
+        columns = next(segments, None)
+        if columns is None:
+            metrics.count('files_skipped')
+            return
+
+        metrics.count('files_parsed')
+        following = next(segments, None)
+        if following is None:
+            activity_doc = self.activity_doc(base_id, user_id, columns, labels, self.options['label_match'])
+            self.count_points(metrics, activity_doc)
+            yield activity_doc, columns
+            return
+
+        how = 'contain' if self.options['label_match'] == 'exact' else self.options['label_match']
+        segment = 0
+        while columns is not None:
+            if segment == MAX_SEGMENTS:
+                metrics.count('segments_dropped')
+                return
+            activity_doc = self.activity_doc(base_id * 100 + segment, user_id, columns, labels, how)
+            self.count_points(metrics, activity_doc)
+            activity_doc['source_activity_id'] = base_id
+            activity_doc['segment'] = segment
+            yield activity_doc, columns
+            columns, following = following, next(segments, None)
+            segment += 1
+
+
+    def count_points(self, metrics, activity_doc):
+        metrics.count('points_parsed', activity_doc['original_point_count'])
+        if self.options['simplify_tolerance_m'] or self.options['simplify_min_step_s']:
+            metrics.count('points_simplified_away', activity_doc['original_point_count'] - activity_doc['point_count'])
+
+
+    def activity_id(self, file_path, user_id):
+        return int(os.path.basename(file_path).split('.')[0] + user_id)
+
+
+    def activity_doc(self, activity_id, user_id, columns, labels, how):
+        """
+        The Activity for a run of points. Its stats come from every parsed
+        point; with simplify_tolerance_m or simplify_min_step_s set only the
+        points simplify_mask keeps are stored, columns is filtered in place.
+        """
+        point_count = len(columns['lat'])
+        start_date_time = columns['date_time'][0].item()
+        end_date_time = columns['date_time'][-1].item()
+
+        transportation_mode = labels.match(start_date_time, end_date_time, how)
+
+        activity_doc = {
+            "_id": activity_id,
+            "user_id": user_id,
+            "transportation_mode": transportation_mode,
+            "start_date_time": start_date_time,
+            "end_date_time": end_date_time,
+            "point_count": point_count,
+            "bbox": [float(columns['lon'].min()), float(columns['lat'].min()),
+                     float(columns['lon'].max()), float(columns['lat'].max())],
+            **activity_metrics(columns),
+            "original_point_count": point_count
+        }
+
+        if self.options['simplify_tolerance_m'] or self.options['simplify_min_step_s']:
+            keep = simplify_mask(columns, self.options['simplify_tolerance_m'], self.options['simplify_min_step_s'])
+            for name in list(columns):
+                columns[name] = columns[name][keep]
+            point_count = activity_doc['point_count'] = int(keep.sum())
+
+        if self.options['layout'] == 'buckets':
+            activity_doc['bucket_count'] = -(-point_count // self.options['bucket_size'])
+        else:
+            columns['_id'] = [ObjectId() for _ in range(point_count)]
+            activity_doc['trackpoint_ids'] = columns['_id']
+
+        return activity_doc
+
+
+    def point_docs(self, activity_doc, columns):
+        if self.options['layout'] == 'buckets':
+            return self.bucket_docs(activity_doc, columns)
+        return self.trackpoint_docs(activity_doc, columns)
+
+
+    def bucket_docs(self, activity_doc, columns):
+        """
+        Packs an activity's points into TrajectoryBucket documents of at most
+        bucket_size points, with every column stored as packed binary.
+        """
+        bucket_size = self.options['bucket_size']
+        bucket_docs = []
+
+        for bucket, start in enumerate(range(0, activity_doc['point_count'], bucket_size)):
+            stop = min(start + bucket_size, activity_doc['point_count'])
+            bucket_docs.append({
+                "activity_id": activity_doc['_id'],
+                "user_id": activity_doc['user_id'],
+                "bucket": bucket,
+                "point_count": stop - start,
+                "start_date_time": columns['date_time'][start].item(),
+                "end_date_time": columns['date_time'][stop - 1].item(),
+                **encode_bucket_columns(columns, start, stop)
+            })
+
+        return bucket_docs
+
+
+    def trackpoint_docs(self, activity_doc, columns):
+        activity_id = activity_doc['_id']
+        trackpoint_docs = [
+            {
+                "_id": _id,
+                "activity_id": activity_id,
+                "lat": lat,
+                "lon": lon,
+                "altitude": altitude,
+                "date_days": date_days,
+                "date_time": date_time
+            }
+            for _id, lat, lon, altitude, date_days, date_time in zip(
+                columns['_id'],
+                columns['lat'].tolist(),
+                columns['lon'].tolist(),
+                columns['altitude'].tolist(),
+                columns['date_days'].tolist(),
+                columns['date_time'].tolist()
+            )
+        ]
+
+        if self.options['geo']:
+            for doc in trackpoint_docs:
+                doc['location'] = {'type': 'Point', 'coordinates': [doc['lon'], doc['lat']]}
+
+        if self.options['denormalize']:
+            # Lets user-level questions be answered from TrackPoint alone
+            for doc in trackpoint_docs:
+                doc['user_id'] = activity_doc['user_id']
+                doc['transportation_mode'] = activity_doc['transportation_mode']
+
+        if self.options['timeseries']:
+            # Points of one activity share their meta, so they end up in the same buckets
+            for doc in trackpoint_docs:
+                doc['meta'] = {name: doc.pop(name) for name in TIMESERIES_META_FIELDS if name in doc}
+                doc['meta']['user_id'] = activity_doc['user_id']
 
+        return trackpoint_docs
 
+
+    @stage
+    def insert_activities(self, base_dir):
+        for user_id, root in self.user_dirs(base_dir):
+            self.insert_user_activities(user_id, root)
+        self.finish_load()
+
+
+    def insert_user_activities(self, user_id, root):
+        labels = self.read_labels(root)
+        activity_docs = []
+
+        for plt_file, file_path in self.plt_files(root):
+            # insert_trackpoints parses the same files again and counts them
+            for activity_doc, _ in self.parse_plt(file_path, user_id, labels, count=False):
+                activity_doc.pop('trackpoint_ids', None)  # Filled in by insert_trackpoints
+                activity_docs.append(activity_doc)
+
+        if activity_docs:
+            result = self.db['Activity'].bulk_write([
+                UpdateOne({"_id": doc["_id"]}, {"$set": doc, "$setOnInsert": {"trackpoint_ids": []}}, upsert=True)
+                for doc in activity_docs
+            ])
+            if self.incremental_rollups():
+                self.update_rollups([activity_docs[i] for i in result.upserted_ids])
+            self.log(f"Inserted {len(activity_docs)} activities for user {user_id}.")
+
+        return len(activity_docs)
+
+
+    @stage
     def insert_trackpoints(self, base_dir):
-        batch_size = 10000  
-        file_count = 0  
+        file_count = 0
 
-        for root, dirs, files in os.walk(base_dir):
-            if 'Trajectory' in dirs:
-                user_id = os.path.basename(root)
-                trajectory_folder = os.path.join(root, 'Trajectory')
-
-                for file_name in os.listdir(trajectory_folder):
-                    file_path = os.path.join(trajectory_folder, file_name)
-                    activity_id = int(file_name.split('.')[0] + user_id)
-
-                    with open(file_path, 'r') as file:
-                        lines = file.readlines()
-                        line_count = len(lines)
-
-                        if line_count - 6 <= 2500:  # Process only files with <= 2500 data lines
-                            print(f"Processing file: {file_name} for user: {user_id}")
-                            trackpoint_docs = []  
-                            trackpoint_ids = []  
-
-                            for line in lines[6:]:
-                                data = line.strip().split(',')
-                                latitude = float(data[0])
-                                longitude = float(data[1])
-                                altitude = float(data[3])
-                                date_days = float(data[4])
-                                date_time_str = data[5] + ' ' + data[6]
-                                date_time = datetime.strptime(date_time_str, "%Y-%m-%d %H:%M:%S")
-
-                                
-                                trackpoint_doc = {
-                                    "activity_id": activity_id,
-                                    "lat": latitude,
-                                    "lon": longitude,
-                                    "altitude": altitude,
-                                    "date_days": date_days,
-                                    "date_time": date_time
-                                }
-                                trackpoint_docs.append(trackpoint_doc)
-
-                                
-                                if len(trackpoint_docs) >= batch_size:
-                                    result = self.db['TrackPoint'].insert_many(trackpoint_docs)
-                                    trackpoint_ids.extend(result.inserted_ids)
-                                    print(f"Inserting batch of {len(trackpoint_docs)} trackpoints...")
-                                    trackpoint_docs.clear() 
-
-                            
-                            if trackpoint_docs:
-                                result = self.db['TrackPoint'].insert_many(trackpoint_docs)
-                                trackpoint_ids.extend(result.inserted_ids)
-                                print(f"Inserting final batch of {len(trackpoint_docs)} trackpoints...")
-
-                            
-                            self.db['Activity'].update_one(
-                                {"_id": activity_id},
-                                {"$push": {"trackpoint_ids": {"$each": trackpoint_ids}}} 
-                            )
-
-                            file_count += 1
+        for user_id, root in self.user_dirs(base_dir):
+            files, _ = self.insert_user_trackpoints(user_id, root)
+            file_count += files
+
+        print(f"Finished processing {file_count} files.")
+        bump_data_version(self.db)
+
+
+    def insert_user_trackpoints(self, user_id, root):
+        file_count = 0
+        point_count = 0
+        # Labels are only needed to stamp transportation_mode on the trackpoints
+        labels = self.read_labels(root) if self.options['denormalize'] else LabelIndex()
+
+        for file_name, file_path in self.plt_files(root):
+            loaded = False
+            for activity_doc, columns in self.parse_plt(file_path, user_id, labels):
+                self.log(f"Processing file: {file_name} for user: {user_id}")
+                trackpoint_docs = self.trackpoint_docs(activity_doc, columns)
+                trackpoint_ids = self.insert_batch('TrackPoint', trackpoint_docs, ordered=True).inserted_ids
+
+                self.db['Activity'].update_one(
+                    {"_id": activity_doc['_id']},
+                    {"$push": {"trackpoint_ids": {"$each": trackpoint_ids}}}
+                )
+
+                loaded = True
+                point_count += len(trackpoint_ids)
+
+            file_count += loaded
+
+        return file_count, point_count
+
+
+    @stage
+    def insert_activities_and_trackpoints(self, base_dir):
+        file_count = 0
+
+        # pending_files deletes by activity_id, which needs the index up front
+        self.db[self.point_collection()].create_index(self.tp_field('activity_id'))
+
+        for user_id, root in self.user_dirs(base_dir):
+            activities, _ = self.insert_user(user_id, root)
+            file_count += activities
 
         print(f"Finished processing {file_count} files.")
+        self.finish_load()
+
+
+    def pending_files(self, user_id, root):
+        """
+        The .plt files of a user that still need loading. With a checkpoint
+        journal, files already loaded unchanged are skipped. Whatever an
+        earlier run or attempt left of the others is removed first, so
+        loading the same tree twice does not duplicate its points.
+        """
+        pending = list(self.plt_files(root))
+
+        if self.checkpoint:
+            pending = [(name, path) for name, path in pending if not self.checkpoint.is_done(user_id, path)]
+            if not pending:
+                self.log(f"User {user_id} is up to date.")
+                return pending
+
+        stale_ids = [self.activity_id(path, user_id) for _, path in pending]
+        split_ids = stale_ids
+        if self.options['long_trajectories'] != 'split':
+            # Only a file loaded under another policy can have left segments behind
+            split_ids = [self.activity_id(path, user_id) for _, path in pending
+                         if self.checkpoint and self.checkpoint.loaded_under_other_policy(user_id, path)]
+        stale_ids += [base_id * 100 + segment for base_id in split_ids for segment in range(MAX_SEGMENTS)]
+        if self.incremental_rollups():
+            stale_activities = self.db['Activity'].find({"_id": {"$in": stale_ids}}, ROLLUP_PROJECTION)
+            self.update_rollups(list(stale_activities), sign=-1)
+        self.db[self.point_collection()].delete_many({self.tp_field('activity_id'): {"$in": stale_ids}})
+        self.db['Activity'].delete_many({"_id": {"$in": stale_ids}})
+
+        return pending
+
+
+    def insert_user(self, user_id, root):
+        """
+        Single pass over a user's .plt files: every file is read once and
+        yields both its Activity and its TrackPoints. TrackPoints are flushed
+        in unordered batches and each Activity is written exactly once, with
+        its trackpoint ids and stats, in one bulk_write at the end.
+        """
+        batch_size = 10000
+        pending = self.pending_files(user_id, root)
+        if not pending:
+            return 0, 0
+
+        labels = self.read_labels(root)
+        collection_name = self.point_collection()
+        activity_docs = []
+        point_batch = []
+        batch_points = 0
+        point_count = 0
+
+        for file_name, file_path in pending:
+            for activity_doc, columns in self.parse_plt(file_path, user_id, labels):
+                self.log(f"Processing file: {file_name} for user: {user_id}")
+                activity_docs.append(activity_doc)
+                point_batch.extend(self.point_docs(activity_doc, columns))
+                batch_points += activity_doc['point_count']
+                point_count += activity_doc['point_count']
+
+                if batch_points >= batch_size:
+                    self.insert_batch(collection_name, point_batch)
+                    point_batch = []
+                    batch_points = 0
+
+        if point_batch:
+            self.insert_batch(collection_name, point_batch)
+
+        if activity_docs:
+            self.write_activities(activity_docs)
+            self.log(f"Inserted {len(activity_docs)} activities for user {user_id}.")
+
+        if self.checkpoint:
+            self.checkpoint.record(user_id, [path for _, path in pending])
+
+        return len(activity_docs), point_count
+
+
+    def insert_batch(self, collection_name, docs, ordered=False):
+        with self.metrics.timer('insert_seconds', collection=collection_name):
+            result = self.db[collection_name].insert_many(docs, ordered=ordered)
+        self.metrics.count('documents_written', len(docs), collection=collection_name)
+        return result
+
+
+    def write_activities(self, activity_docs):
+        with self.metrics.timer('insert_seconds', collection='Activity'):
+            result = self.db['Activity'].bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True)
+                                                     for doc in activity_docs], ordered=False)
+        self.metrics.count('documents_written', len(activity_docs), collection='Activity')
+        if self.incremental_rollups():
+            # Replaced activities were counted when first inserted
+            self.update_rollups([activity_docs[i] for i in result.upserted_ids])
+
+
+    def incremental_rollups(self):
+        """
+        Whether every write folds its activities into ActivityRollup. Unacknowledged
+        writes (w:0) report no upserted ids, those loads rebuild the rollups in finish_load.
+        """
+        return self.options['rollups'] and self.db.write_concern.acknowledged
 
 
+    def finish_load(self):
+        if self.options['rollups'] and not self.db.write_concern.acknowledged:
+            self.refresh_rollups()
+        else:
+            bump_data_version(self.db)
+
+
+    def update_rollups(self, activity_docs, sign=1):
+        """
+        Folds activities into the ActivityRollup counters (user x year x mode),
+        or takes them out again with sign=-1.
+        """
+        totals = defaultdict(lambda: [0, 0, 0.0])
+        for doc in activity_docs:
+            key = (doc['user_id'], doc['start_date_time'].year, doc['transportation_mode'])
+            totals[key][0] += 1
+            totals[key][1] += activity_hours(doc['start_date_time'], doc['end_date_time'])
+            totals[key][2] += doc.get('distance_km', 0.0)
+
+        if not totals:
+            return
+
+        self.db['ActivityRollup'].bulk_write([
+            UpdateOne(
+                {"_id": {"user_id": user_id, "year": year, "transportation_mode": mode}},
+                {"$inc": {"activity_count": sign * count, "hours": sign * hours, "distance_km": sign * distance}},
+                upsert=True
+            )
+            for (user_id, year, mode), (count, hours, distance) in totals.items()
+        ], ordered=False)
+
+        if sign < 0:
+            self.db['ActivityRollup'].delete_many({"activity_count": {"$lte": 0}})
+
+
+    @stage
+    def refresh_rollups(self):
+        """
+        Rebuilds ActivityRollup from scratch with a $merge over Activity.
+        """
+        # The delete has to land before the $merge, even when loads run with w:0
+        db = self.db if self.db.write_concern.acknowledged else self.db.with_options(write_concern=WriteConcern(w=1))
+        db['ActivityRollup'].delete_many({})
+        db['Activity'].aggregate([
+            {
+                '$group': {
+                    '_id': {
+                        'user_id': '$user_id',
+                        'year': {'$year': '$start_date_time'},
+                        'transportation_mode': '$transportation_mode'
+                    },
+                    'activity_count': {'$sum': 1},
+                    'hours': {
+                        '$sum': {
+                            '$dateDiff': {
+                                'startDate': '$start_date_time',
+                                'endDate': '$end_date_time',
+                                'unit': 'hour'
+                            }
+                        }
+                    },
+                    'distance_km': {'$sum': {'$ifNull': ['$distance_km', 0]}}
+                }
+            },
+            {
+                '$merge': {'into': 'ActivityRollup', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}
+            }
+        ])
+        print("Activity rollups refreshed.")
+        bump_data_version(self.db)
+
+
+    @stage
+    def insert_async(self, base_dir, writers=4, queue_size=8):
+        """
+        Loads activities and trackpoints with reading/parsing and Mongo writes
+        overlapped. A parser thread fills a bounded queue with TrackPoint and
+        Activity batches and `writers` threads drain it with unordered bulk
+        writes, so up to `writers` writes are in flight while the next files
+        are parsed. The queue bound keeps memory flat when Mongo falls behind.
+        """
+        self.db[self.point_collection()].create_index(self.tp_field('activity_id'))
+
+        counts = asyncio.run(self._insert_async(base_dir, writers, queue_size))
+        print(f"Finished processing {counts[0]} files, {counts[1]} trackpoints.")
+        self.finish_load()
+        return counts
+
+
+    async def _insert_async(self, base_dir, writers, queue_size):
+        batch_size = 10000
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=queue_size)
+        parse_executor = ThreadPoolExecutor(max_workers=1)
+        write_executor = ThreadPoolExecutor(max_workers=writers)
+        loaded = []
+        counts = [0, 0]
+
+        async def produce():
+            for user_id, root in self.user_dirs(base_dir):
+                pending = await loop.run_in_executor(parse_executor, self.pending_files, user_id, root)
+                if not pending:
+                    continue
+
+                labels = await loop.run_in_executor(parse_executor, self.read_labels, root)
+                activity_docs = []
+                point_batch = []
+                batch_points = 0
+
+                for file_name, file_path in pending:
+                    # One segment at a time, each read on the parser thread
+                    segments = self.parse_plt(file_path, user_id, labels)
+                    parsed = await loop.run_in_executor(parse_executor, next, segments, None)
+                    if parsed:
+                        counts[0] += 1
+
+                    while parsed:
+                        activity_doc, columns = parsed
+                        activity_docs.append(activity_doc)
+                        point_batch.extend(self.point_docs(activity_doc, columns))
+                        batch_points += activity_doc['point_count']
+                        counts[1] += activity_doc['point_count']
+
+                        if batch_points >= batch_size:
+                            await queue.put((self.point_collection(), point_batch))
+                            point_batch = []
+                            batch_points = 0
+
+                        parsed = await loop.run_in_executor(parse_executor, next, segments, None)
+
+                if point_batch:
+                    await queue.put((self.point_collection(), point_batch))
+                if activity_docs:
+                    await queue.put(('Activity', activity_docs))
+                loaded.append((user_id, [path for _, path in pending]))
+
+            for _ in range(writers):
+                await queue.put(None)
+
+        def write(collection_name, docs):
+            if collection_name == 'Activity':
+                self.write_activities(docs)
+            else:
+                self.insert_batch(collection_name, docs)
+
+        async def consume():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                await loop.run_in_executor(write_executor, write, *item)
+
+        try:
+            await asyncio.gather(produce(), *(consume() for _ in range(writers)))
+        finally:
+            parse_executor.shutdown()
+            write_executor.shutdown()
+
+        # Recorded only after every batch is acknowledged, a user's writes can still be in flight before that
+        if self.checkpoint:
+            for user_id, file_paths in loaded:
+                self.checkpoint.record(user_id, file_paths)
+
+        return tuple(counts)
+
+
+    @stage
+    def insert_parallel(self, base_dir, processes=None):
+        """
+        Loads activities and trackpoints with users sharded across a process pool.
+        Every worker opens its own MongoClient, since clients can not be shared across a fork.
+        """
+        users = list(self.user_dirs(base_dir))
+        user_counts = {}
+        # Workers delete by activity_id in pending_files, which needs the index up front
+        self.db[self.point_collection()].create_index(self.tp_field('activity_id'))
+
+        with Pool(processes=processes, initializer=_init_worker, initargs=(self.options,)) as pool:
+            for user_id, activities, points, worker_metrics in pool.imap_unordered(_ingest_user, users):
+                user_counts[user_id] = (activities, points)
+                self.metrics.merge(worker_metrics)
+            # Let the workers exit on their own, leaving the with block terminates them before they close their clients
+            pool.close()
+            pool.join()
+
+        table = [(user_id, *counts) for user_id, counts in sorted(user_counts.items())]
+        totals = [sum(row[i] for row in table) for i in range(1, 3)]
+        table.append(('Total', *totals))
+        print(tabulate(table, headers=['User ID', 'Activities', 'TrackPoints'], tablefmt="pretty"))
+
+        self.finish_load()
+        return user_counts
+
+
+    @stage
     def create_indexes(self):
         
         self.db['Activity'].create_index('user_id')
@@ -170,9 +965,28 @@ class Task_1_Program:
         self.db['Activity'].create_index([('start_date_time', 1), ('end_date_time', 1)])
 
         
-        self.db['TrackPoint'].create_index('activity_id')
+        if self.options['layout'] == 'buckets':
+            self.db['TrajectoryBucket'].create_index([('activity_id', 1), ('bucket', 1)], unique=True)
+            self.db['TrajectoryBucket'].create_index([('user_id', 1), ('start_date_time', 1)])
+            print("Indexes created successfully.")
+            return
+
+        activity_id = self.tp_field('activity_id')
+        user_id = self.tp_field('user_id')
+        self.db['TrackPoint'].create_index([(activity_id, 1), ('date_time', 1)] if self.options['timeseries'] else activity_id)
         self.db['TrackPoint'].create_index([('lat', 1), ('lon', 1)]) 
-        self.db['TrackPoint'].create_index('date_time') 
+        if not self.options['timeseries']:
+            # A time-series collection already clusters its buckets by time
+            self.db['TrackPoint'].create_index('date_time') 
+        if self.options['geo']:
+            self.db['TrackPoint'].create_index([('location', '2dsphere')])
+        if self.options['denormalize'] or self.options['timeseries']:
+            self.db['TrackPoint'].create_index([(user_id, 1), ('date_time', 1)])
+            self.db['TrackPoint'].create_index([('lat', 1), ('lon', 1), (user_id, 1)])
+            if self.options['geo']:
+                self.db['TrackPoint'].create_index([('location', '2dsphere'), (user_id, 1)])
+        if self.options['denormalize']:
+            self.db['TrackPoint'].create_index([(self.tp_field('transportation_mode'), 1), (user_id, 1)])
 
         print("Indexes created successfully.")
 
@@ -186,6 +1000,10 @@ class Task_1_Program:
     def drop_coll(self, collection_name):
         collection = self.db[collection_name]
         collection.drop()
+        if collection_name == 'Activity':
+            # The rollups count Activity documents, they go with them
+            self.db['ActivityRollup'].drop()
+        bump_data_version(self.db)
 
         
     def show_coll(self):
@@ -199,22 +1017,76 @@ class Task_1_Program:
 
     def empty_collection(self, collectionName):
         self.db[collectionName].delete_many({})
+        if collectionName == 'Activity':
+            self.db['ActivityRollup'].delete_many({})
         print(f"All {collectionName} have been deleted from the collection.")
+        bump_data_version(self.db)
+
+    def print_stats(self):
+        """
+        Stage times, parse throughput and write/command latencies of this run.
+        """
+        stats = self.metrics.to_dict()
+        counters = stats['counters']
+        rates = stats['rates_per_s']
+        print(f"Parsed {counters.get('files_parsed', 0)} files ({rates.get('files_parsed', 0):.1f}/s), "
+              f"{counters.get('points_parsed', 0)} points ({rates.get('points_parsed', 0):.0f}/s), "
+              f"skipped {counters.get('files_skipped', 0)} files.")
+
+        table = [(key, histogram['count'], round(histogram['sum'], 3), round(histogram['p50'] * 1000, 1),
+                  round(histogram['p95'] * 1000, 1), round(histogram['max'] * 1000, 1))
+                 for key, histogram in sorted(stats['histograms'].items())]
+        print(tabulate(table, headers=['Timer', 'Count', 'Total (s)', 'p50 (ms)', 'p95 (ms)', 'Max (ms)'],
+                       tablefmt="pretty"))
+
+_worker_program = None
+
+
+def _init_worker(options):
+    global _worker_program
+    _worker_program = Task_1_Program(**options)
+    # Pool workers leave through os._exit, which skips atexit but runs multiprocessing finalizers
+    util.Finalize(_worker_program, _worker_program.connection.close_connection, exitpriority=10)
+
+
+def _ingest_user(user):
+    user_id, root = user
+    activities, points = _worker_program.insert_user(user_id, root)
+    return user_id, activities, points, _worker_program.metrics.drain()
+
 
 def main():
     program = None
     try:
-        program = Task_1_Program()
+        program = Task_1_Program(checkpoint=os.environ.get('INGEST_CHECKPOINT'),
+                                 timeseries=bool(os.environ.get('TRACKPOINT_TIMESERIES')),
+                                 layout=os.environ.get('TRACKPOINT_LAYOUT', 'points'),
+                                 quiet=bool(os.environ.get('INGEST_QUIET')),
+                                 long_trajectories=os.environ.get('LONG_TRAJECTORIES', 'skip'),
+                                 plt_cache=os.environ.get('PLT_CACHE_DIR'),
+                                 simplify_tolerance_m=float(os.environ.get('SIMPLIFY_TOLERANCE_M', 0)) or None,
+                                 simplify_min_step_s=float(os.environ.get('SIMPLIFY_MIN_STEP_S', 0)) or None,
+                                 profile_dir=os.environ.get('PROFILE_DIR'))
         program.create_coll('User')
         program.create_coll('Activity')
         program.create_coll('TrackPoint')
         program.show_coll()
         program.insert_users(base_dir="dataset/dataset/Data", labeled_ids_file="dataset/dataset/labeled_ids.txt")
-        program.insert_activities(base_dir="dataset/dataset/Data")
-        program.insert_trackpoints(base_dir="dataset/dataset/Data")
+        if program.plt_cache:
+            program.convert_plt_files(base_dir="dataset/dataset/Data")
+        processes = os.environ.get('INGEST_PROCESSES')
+        if processes:
+            program.insert_parallel(base_dir="dataset/dataset/Data", processes=int(processes))
+        elif os.environ.get('INGEST_ASYNC'):
+            program.insert_async(base_dir="dataset/dataset/Data")
+        else:
+            program.insert_activities_and_trackpoints(base_dir="dataset/dataset/Data")
         #program.empty_collection('Activity')
         #program.list_all_users()
         program.create_indexes()
+        program.print_stats()
+        if os.environ.get('METRICS_FILE'):
+            program.metrics.write(os.environ['METRICS_FILE'])
     except Exception as e:
         print("ERROR: Failed to use database:", e)
     finally:
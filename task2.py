@@ -1,4 +1,7 @@
 from pprint import pprint
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from DbConnector import DbConnector
 from pymongo import MongoClient
 from datetime import datetime
@@ -6,36 +9,81 @@ from haversine import haversine, Unit
 from tabulate import tabulate
 from collections import defaultdict
 from tqdm import tqdm
+import numpy as np
+from query_cache import QueryCache, read_data_version
+from metrics import Metrics, CommandLatencyListener, timed
+from trajectory import EARTH_RADIUS_KM, BUCKET_COLUMNS, distance_km, altitude_gain_m, max_gap_s, decode_bucket_columns, \
+    proximity_pairs, haversine_m, points_in_polygon
+
+
+def haversine_expr(lat1, lon1, lat2, lon2):
+    """
+    Aggregation expression for the haversine distance in kilometers
+    between two points given as field paths or expressions.
+    """
+    lat1, lon1, lat2, lon2 = ({'$degreesToRadians': value} for value in (lat1, lon1, lat2, lon2))
+    sin_dlat = {'$sin': {'$divide': [{'$subtract': [lat2, lat1]}, 2]}}
+    sin_dlon = {'$sin': {'$divide': [{'$subtract': [lon2, lon1]}, 2]}}
+    a = {
+        '$add': [
+            {'$pow': [sin_dlat, 2]},
+            {'$multiply': [{'$cos': lat1}, {'$cos': lat2}, {'$pow': [sin_dlon, 2]}]}
+        ]
+    }
+    return {'$multiply': [2 * EARTH_RADIUS_KM, {'$asin': {'$sqrt': a}}]}
 
 class Task_2_Program:
 
-    def __init__(self):
-        self.connection = DbConnector()
+    def __init__(self, cache=True, cache_ttl=3600, cache_dir=None, verbose=True, profile_dir=None):
+        self.metrics = Metrics(profile_dir)
+        self.connection = DbConnector(profile='analytics', event_listeners=[CommandLatencyListener(self.metrics)])
         self.client = self.connection.client
         self.db = self.connection.db
+        self._denormalized = None
+        self._timeseries = None
+        self._buckets = None
+        self._metrics = None
+        self._rollups = None
+        self.verbose = verbose
+        self.cache = QueryCache(ttl=cache_ttl, cache_dir=cache_dir) if cache else None
+
+    def log(self, *args):
+        if self.verbose:
+            print(*args)
 
     def show_collections(self):
-        print("Showing collections:")
+        self.log("Showing collections:")
         collections = self.db.list_collection_names()
-        print(collections)
+        self.log(collections)
+        return collections
 
+    @timed('query_seconds')
     def count_users_activities_trackpoints(self):
-        user_count = self.db['User'].count_documents({})
-        activity_count = self.db['Activity'].count_documents({})
-        trackpoint_count = self.db['TrackPoint'].count_documents({})
+        def count():
+            user_count = self.db['User'].count_documents({})
+            activity_count = self.db['Activity'].count_documents({})
+            if self.trajectory_buckets():
+                result = list(self.db['TrajectoryBucket'].aggregate([
+                    {'$group': {'_id': None, 'point_count': {'$sum': '$point_count'}}}
+                ]))
+                trackpoint_count = result[0]['point_count'] if result else 0
+            else:
+                trackpoint_count = self.db['TrackPoint'].count_documents({})
+            return user_count, activity_count, trackpoint_count
 
-        return user_count, activity_count, trackpoint_count
+        return self._cached('count_users_activities_trackpoints', {}, count)
     
+    @timed('query_seconds')
     def avg_activities_per_user(self):
-        user_count = self.db['User'].count_documents({})
-
-        activity_count = self.db['Activity'].count_documents({})
+        user_count, activity_count, _ = self.count_users_activities_trackpoints()
 
         avg_activities = activity_count / user_count if user_count > 0 else 0
 
         return avg_activities
 
-    def top_20_users_with_most_activities(self):
+    @timed('query_seconds')
+    def top_20_users_with_most_activities(self, source='auto'):
+        collection = 'Activity'
         pipeline = [
             {
                 '$group': {
@@ -51,29 +99,40 @@ class Task_2_Program:
             }
         ]
 
-        top_20_users = list(self.db['Activity'].aggregate(pipeline))
+        if self.use_rollups(source):
+            collection = 'ActivityRollup'
+            pipeline[0] = {'$group': {'_id': '$_id.user_id', 'activity_count': {'$sum': '$activity_count'}}}
+
+        top_20_users = self._cached('top_20_users_with_most_activities', {'source': source},
+                                    lambda: list(self.db[collection].aggregate(pipeline)))
 
         table = [(user['_id'], user['activity_count']) for user in top_20_users]
         headers = ['User ID', 'Activity Count']
 
-        print("\nTop 20 Users with Most Activities:")
-        print(tabulate(table, headers, tablefmt="pretty"))
+        self.log("\nTop 20 Users with Most Activities:")
+        self.log(tabulate(table, headers, tablefmt="pretty"))
 
         return top_20_users
     
 
-    def find_taxi_users(self):
-        taxi_users = self.db['Activity'].distinct('user_id', {'transportation_mode': 'taxi'})
+    @timed('query_seconds')
+    def find_taxi_users(self, mode='taxi'):
+        taxi_users = self._cached('find_taxi_users', {'mode': mode},
+                                  lambda: self.db['Activity'].distinct('user_id', {'transportation_mode': mode}))
         
         if taxi_users:
-            print("\nUsers who have taken a taxi:")
+            self.log(f"\nUsers who have taken a {mode}:")
             table = [(user,) for user in taxi_users]
-            print(tabulate(table, headers=["User ID"], tablefmt="pretty"))
+            self.log(tabulate(table, headers=["User ID"], tablefmt="pretty"))
         else:
-            print("No users have taken a taxi.")
+            self.log(f"No users have taken a {mode}.")
+
+        return taxi_users
 
 
-    def count_transportation_modes(self):
+    @timed('query_seconds')
+    def count_transportation_modes(self, source='auto'):
+        collection = 'Activity'
         pipeline = [
             {
                 '$match': {
@@ -91,16 +150,28 @@ class Task_2_Program:
             }
         ]
 
-        modes = list(self.db['Activity'].aggregate(pipeline))
+        if self.use_rollups(source):
+            collection = 'ActivityRollup'
+            pipeline[:2] = [
+                {'$match': {'_id.transportation_mode': {'$ne': None}}},
+                {'$group': {'_id': '$_id.transportation_mode', 'mode_count': {'$sum': '$activity_count'}}}
+            ]
+
+        modes = self._cached('count_transportation_modes', {'source': source},
+                             lambda: list(self.db[collection].aggregate(pipeline)))
 
         if modes:
-            print("\nTransportation modes and their activity counts (sorted by count):")
+            self.log("\nTransportation modes and their activity counts (sorted by count):")
             table = [(mode['_id'], mode['mode_count']) for mode in modes]
-            print(tabulate(table, headers=["Transportation Mode", "Count"], tablefmt="pretty"))
+            self.log(tabulate(table, headers=["Transportation Mode", "Count"], tablefmt="pretty"))
         else:
-            print("No transportation modes found.")
+            self.log("No transportation modes found.")
+
+        return modes
 
-    def find_year_with_most_activities_and_hours(self):
+    @timed('query_seconds')
+    def find_year_with_most_activities_and_hours(self, source='auto'):
+        collection = 'Activity'
         pipeline_activities = [
             {
                 '$group': {
@@ -116,7 +187,12 @@ class Task_2_Program:
             }
         ]
 
-        most_activities_year = list(self.db['Activity'].aggregate(pipeline_activities))
+        if self.use_rollups(source):
+            collection = 'ActivityRollup'
+            pipeline_activities[0] = {'$group': {'_id': '$_id.year', 'activity_count': {'$sum': '$activity_count'}}}
+
+        most_activities_year = self._cached('find_year_with_most_activities', {'source': source},
+                                            lambda: list(self.db[collection].aggregate(pipeline_activities)))
 
         pipeline_hours = [
             {
@@ -141,7 +217,11 @@ class Task_2_Program:
             }
         ]
 
-        most_hours_year = list(self.db['Activity'].aggregate(pipeline_hours))
+        if self.use_rollups(source):
+            pipeline_hours[0] = {'$group': {'_id': '$_id.year', 'total_hours': {'$sum': '$hours'}}}
+
+        most_hours_year = self._cached('find_year_with_most_hours', {'source': source},
+                                       lambda: list(self.db[collection].aggregate(pipeline_hours)))
 
         if most_activities_year and most_hours_year:
             activity_year = most_activities_year[0]['_id']
@@ -150,24 +230,112 @@ class Task_2_Program:
             hours_year = most_hours_year[0]['_id']
             total_hours = most_hours_year[0]['total_hours']
 
-            print(f"Year with most activities: {activity_year} (Activities: {activity_count})")
-            print(f"Year with most recorded hours: {hours_year} (Total Hours: {total_hours:.2f})")
+            self.log(f"Year with most activities: {activity_year} (Activities: {activity_count})")
+            self.log(f"Year with most recorded hours: {hours_year} (Total Hours: {total_hours:.2f})")
 
             if activity_year == hours_year:
-                print(f"Yes, {activity_year} is also the year with the most recorded hours.")
+                self.log(f"Yes, {activity_year} is also the year with the most recorded hours.")
             else:
-                print(f"No, the year with the most recorded hours is {hours_year}.")
+                self.log(f"No, the year with the most recorded hours is {hours_year}.")
+
+            return {
+                'activity_year': activity_year,
+                'activity_count': activity_count,
+                'hours_year': hours_year,
+                'total_hours': total_hours
+            }
         else:
-            print("No activities found.")
+            self.log("No activities found.")
             
-    def distance_walked(self):
+    @timed('query_seconds')
+    def distance_walked(self, user_id="112", year=2008, mode="walk", engine='auto'):
+        engine = self.resolve_engine(engine)
+
+        compute = getattr(self, f'_distance_walked_{engine}')
+        total_distance = self._cached('distance_walked', {'user_id': user_id, 'year': year, 'mode': mode, 'engine': engine},
+                                      lambda: compute(user_id, year, mode))
+
+        self.log(f"Total distance ({mode}) by user {user_id} in {year}: {round(total_distance,2)} km")
+        return total_distance
+
+    def _distance_walked_metrics(self, user_id, year, mode):
+        year_start = datetime(year, 1, 1)
+        year_end = datetime(year, 12, 31, 23, 59, 59)
+
+        pipeline = [
+            {
+                '$match': {
+                    "user_id": user_id,
+                    "transportation_mode": mode,
+                    "start_date_time": {"$gte": year_start, "$lt": year_end}
+                }
+            },
+            {
+                '$group': {'_id': None, 'total_distance': {'$sum': '$distance_km'}}
+            }
+        ]
+
+        result = list(self.db['Activity'].aggregate(pipeline))
+        return result[0]['total_distance'] if result else 0
+
+    def _distance_walked_pipeline(self, user_id, year, mode):
+        year_start = datetime(year, 1, 1)
+        year_end = datetime(year, 12, 31, 23, 59, 59)
+
+        pipeline = [
+            {
+                '$match': {
+                    "user_id": user_id,
+                    "transportation_mode": mode,
+                    "start_date_time": {"$gte": year_start, "$lt": year_end}
+                }
+            },
+            *self._trackpoint_lookup({'lat': 1, 'lon': 1}),
+            {
+                '$setWindowFields': {
+                    'partitionBy': '$activity_id',
+                    'sortBy': {'date_time': 1},
+                    'output': {
+                        'prev_lat': {'$shift': {'output': '$lat', 'by': -1}},
+                        'prev_lon': {'$shift': {'output': '$lon', 'by': -1}}
+                    }
+                }
+            },
+            {
+                '$match': {'prev_lat': {'$ne': None}}
+            },
+            {
+                '$group': {
+                    '_id': None,
+                    'total_distance': {'$sum': haversine_expr('$prev_lat', '$prev_lon', '$lat', '$lon')}
+                }
+            }
+        ]
+
+        result = list(self.db['Activity'].aggregate(pipeline, allowDiskUse=True))
+        return result[0]['total_distance'] if result else 0
 
-        year_start = datetime(2008, 1, 1)
-        year_end = datetime(2008, 12, 31, 23, 59, 59)
+    def _distance_walked_numpy(self, user_id, year, mode):
+        year_start = datetime(year, 1, 1)
+        year_end = datetime(year, 12, 31, 23, 59, 59)
+
+        activity_ids = self.db['Activity'].distinct('_id', {
+            "user_id": user_id,
+            "transportation_mode": mode,
+            "start_date_time": {"$gte": year_start, "$lt": year_end}
+        })
+
+        return sum(distance_km(points['lat'], points['lon'])
+                   for _, points in self.load_trackpoint_arrays(activity_ids, ('lat', 'lon')))
+
+    def _distance_walked_legacy(self, user_id, year, mode):
+
+        year_start = datetime(year, 1, 1)
+        year_end = datetime(year, 12, 31, 23, 59, 59)
 
         activities = self.db['Activity'].find({
-            "user_id": "112",
-            "transportation_mode": "walk",
+            "user_id": user_id,
+            "transportation_mode": mode,
             "start_date_time": {"$gte": year_start, "$lt": year_end}
         })
 
@@ -194,11 +362,157 @@ class Task_2_Program:
                 prev_lat = lat
                 prev_lon = lon
 
-        print(f"Total distance walked by user 112 in 2008: {round(total_distance,2)} km")
         return total_distance
 
-    def get_most_used_transportation_mode(self):
-            print("Finding users with their most used transportation mode...")
+    def load_trackpoint_arrays(self, activity_ids, fields, activities_per_query=1000, batch_size=50000):
+        """
+        Streams the trackpoints of many activities with one query per chunk of
+        activity ids and yields (activity_id, columns), where columns maps each
+        field and 'date_time' to a NumPy array sorted by time.
+        """
+        activity_ids = list(activity_ids)
+        if self.trajectory_buckets():
+            yield from self._load_bucket_arrays(activity_ids, fields, activities_per_query, batch_size)
+            return
+
+        activity_field = self.tp_field('activity_id')
+        projection = {'_id': 0, activity_field: 1, 'date_time': 1, **{field: 1 for field in fields}}
+
+        for i in range(0, len(activity_ids), activities_per_query):
+            chunk = activity_ids[i:i + activities_per_query]
+            rows = defaultdict(list)
+
+            cursor = self.db['TrackPoint'].find({activity_field: {'$in': chunk}}, projection).batch_size(batch_size)
+            for trackpoint in cursor:
+                activity_id = trackpoint['meta']['activity_id'] if 'meta' in trackpoint else trackpoint['activity_id']
+                rows[activity_id].append(trackpoint)
+
+            for activity_id, trackpoints in rows.items():
+                date_time = np.array([tp['date_time'] for tp in trackpoints], dtype='datetime64[ms]')
+                order = np.argsort(date_time, kind='stable')
+                columns = {'date_time': date_time[order]}
+                for field in fields:
+                    columns[field] = np.array([tp[field] for tp in trackpoints], dtype='f8')[order]
+                yield activity_id, columns
+
+    def _cached(self, method, params, compute):
+        """
+        compute() through the query cache, keyed by method, params and the
+        data version that ingestion bumps after every load.
+        """
+        if self.cache is None:
+            return compute()
+
+        def miss():
+            self.metrics.count('query_cache_misses', method=method)
+            return compute()
+
+        self.metrics.count('query_cache_lookups', method=method)
+        return self.cache.get_or_compute(method, params, read_data_version(self.db), miss)
+
+    def resolve_engine(self, engine):
+        """
+        The engine a trajectory report runs on. 'auto' prefers the metrics
+        stored on Activity. The pipeline and legacy engines read TrackPoint,
+        which stays empty when the points were loaded into TrajectoryBucket.
+        """
+        if engine == 'auto':
+            if self.activity_metrics():
+                return 'metrics'
+            return 'numpy' if self.trajectory_buckets() else 'pipeline'
+        if engine in ('pipeline', 'legacy') and self.trajectory_buckets():
+            raise ValueError(f"engine='{engine}' reads TrackPoint, but the points were loaded with layout='buckets', "
+                             "use engine='numpy' or 'metrics'")
+        return engine
+
+    def use_rollups(self, source):
+        """
+        Whether an Activity report should read the ActivityRollup counters.
+        source='auto' uses them when ingestion has built them.
+        """
+        if source != 'auto':
+            return source == 'rollup'
+        if self._rollups is None:
+            self._rollups = self.db['ActivityRollup'].find_one({}, {'_id': 1}) is not None
+        return self._rollups
+
+    def activity_metrics(self):
+        """
+        True if the activities carry the distance, altitude gain and time gap
+        metrics computed at ingest, so the trajectory reports can skip TrackPoint.
+        """
+        if self._metrics is None:
+            activity = self.db['Activity'].find_one({}, {'distance_km': 1})
+            self._metrics = activity is not None and 'distance_km' in activity
+        return self._metrics
+
+    def trajectory_buckets(self):
+        """
+        True if the points were loaded with layout='buckets' into TrajectoryBucket.
+        """
+        if self._buckets is None:
+            self._buckets = self.db['TrajectoryBucket'].find_one({}, {'_id': 1}) is not None
+        return self._buckets
+
+    def load_trajectory(self, activity_id, fields=BUCKET_COLUMNS):
+        """
+        A whole activity from its TrajectoryBucket documents, usually a single
+        document read, as NumPy arrays decoded without copying.
+        """
+        buckets = self.db['TrajectoryBucket'].find({'activity_id': activity_id}).sort('bucket', 1)
+        return self._merge_buckets(list(buckets), fields)
+
+    def _load_bucket_arrays(self, activity_ids, fields, activities_per_query, batch_size):
+        projection = {'_id': 0, 'activity_id': 1, 'bucket': 1, 'date_time': 1, **{field: 1 for field in fields}}
+
+        for i in range(0, len(activity_ids), activities_per_query):
+            chunk = activity_ids[i:i + activities_per_query]
+            rows = defaultdict(list)
+
+            cursor = self.db['TrajectoryBucket'].find({'activity_id': {'$in': chunk}}, projection).batch_size(batch_size)
+            for bucket in cursor:
+                rows[bucket['activity_id']].append(bucket)
+
+            for activity_id, buckets in rows.items():
+                buckets.sort(key=lambda bucket: bucket['bucket'])
+                yield activity_id, self._merge_buckets(buckets, fields)
+
+    def _merge_buckets(self, buckets, fields):
+        decoded = [decode_bucket_columns(bucket, fields) for bucket in buckets]
+        if len(decoded) == 1:
+            return decoded[0]
+        return {name: np.concatenate([columns[name] for columns in decoded]) for name in decoded[0]}
+
+    def _trackpoint_lookup(self, projection):
+        """
+        Pipeline stages that join an Activity stream with its TrackPoints on
+        activity_id and emit one document per trackpoint, carrying the
+        activity's user_id along.
+        """
+        return [
+            {
+                '$lookup': {
+                    'from': 'TrackPoint',
+                    'localField': '_id',
+                    'foreignField': self.tp_field('activity_id'),
+                    'pipeline': [{'$project': {'_id': 0, 'date_time': 1, **projection}}],
+                    'as': 'trackpoints'
+                }
+            },
+            {
+                '$unwind': '$trackpoints'
+            },
+            {
+                '$replaceRoot': {
+                    'newRoot': {'$mergeObjects': ['$trackpoints', {'activity_id': '$_id', 'user_id': '$user_id'}]}
+                }
+            }
+        ]
+
+    @timed('query_seconds')
+    def get_most_used_transportation_mode(self, source='auto'):
+            self.log("Finding users with their most used transportation mode...")
+            collection = 'Activity'
 
             pipeline = [
                 {"$match": {"transportation_mode": {"$ne": None}}},  
@@ -219,7 +533,23 @@ class Task_2_Program:
                 }
             ]
 
-            result = self.db['Activity'].aggregate(pipeline)
+            if self.use_rollups(source):
+                collection = 'ActivityRollup'
+                pipeline[:2] = [
+                    {"$match": {"_id.transportation_mode": {"$ne": None}}},
+                    {
+                        "$group": {
+                            "_id": {
+                                "user_id": "$_id.user_id",
+                                "transportation_mode": "$_id.transportation_mode"
+                            },
+                            "mode_count": {"$sum": "$activity_count"}
+                        }
+                    }
+                ]
+
+            result = self._cached('get_most_used_transportation_mode', {'source': source},
+                                  lambda: list(self.db[collection].aggregate(pipeline)))
             
             most_used_modes = defaultdict(lambda: (None, 0))  
 
@@ -234,17 +564,102 @@ class Task_2_Program:
             if most_used_modes:
                 table_data = [[user_id, mode] for user_id, (mode, _) in sorted(most_used_modes.items())]
                 table = tabulate(table_data, headers=["User ID", "Most Used Transportation Mode"], tablefmt="pretty")
-                print("\nMost used transportation modes per user:")
-                print(table)
+                self.log("\nMost used transportation modes per user:")
+                self.log(table)
             else:
-                print("No transportation mode data available.")
+                self.log("No transportation mode data available.")
+
+            return {user_id: mode for user_id, (mode, _) in most_used_modes.items()}
+
+    @timed('query_seconds')
+    def top_20_users_by_altitude_gain(self, engine='auto'):
+        engine = self.resolve_engine(engine)
+
+        top_20_users = self._cached('top_20_users_by_altitude_gain', {'engine': engine}, getattr(self, f'_altitude_gain_{engine}'))
+
+        if top_20_users:
+            self.log("Top 20 Users by Altitude Gain (User ID, Total Meters Gained):")
+            self.log(tabulate(top_20_users, headers=["User ID", "Total Meters Gained"], tablefmt="grid"))
+        else:
+            self.log("No altitude data found.")
+
+        return top_20_users
+
+    def _altitude_gain_metrics(self):
+        pipeline = [
+            {
+                '$group': {'_id': '$user_id', 'altitude_gain': {'$sum': '$altitude_gain_m'}}
+            },
+            {
+                '$match': {'altitude_gain': {'$gt': 0}}
+            },
+            {
+                '$sort': {'altitude_gain': -1}
+            },
+            {
+                '$limit': 20
+            }
+        ]
+
+        result = self.db['Activity'].aggregate(pipeline)
+        return [(user['_id'], user['altitude_gain']) for user in result]
+
+    def _altitude_gain_pipeline(self):
+        pipeline = [
+            {
+                '$project': {'user_id': 1}
+            },
+            *self._trackpoint_lookup({'altitude': 1}),
+            {
+                '$setWindowFields': {
+                    'partitionBy': '$activity_id',
+                    'sortBy': {'date_time': 1},
+                    'output': {
+                        'prev_altitude': {'$shift': {'output': '$altitude', 'by': -1}}
+                    }
+                }
+            },
+            {
+                '$match': {
+                    'prev_altitude': {'$ne': None},
+                    'altitude': {'$ne': -777},
+                    '$expr': {'$gt': ['$altitude', '$prev_altitude']}
+                }
+            },
+            {
+                '$group': {
+                    '_id': '$user_id',
+                    'altitude_gain': {'$sum': {'$multiply': [{'$subtract': ['$altitude', '$prev_altitude']}, 0.3048]}}
+                }
+            },
+            {
+                '$sort': {'altitude_gain': -1}
+            },
+            {
+                '$limit': 20
+            }
+        ]
+
+        result = self.db['Activity'].aggregate(pipeline, allowDiskUse=True)
+        return [(user['_id'], user['altitude_gain']) for user in result]
+
+    def _altitude_gain_numpy(self):
+        activity_users = {activity['_id']: activity['user_id']
+                          for activity in self.db['Activity'].find({}, {'user_id': 1})}
+        user_altitude_gain = defaultdict(float)
+
+        for activity_id, points in self.load_trackpoint_arrays(activity_users, ('altitude',)):
+            user_altitude_gain[activity_users[activity_id]] += altitude_gain_m(points['altitude'])
+
+        gains = [(user_id, gain) for user_id, gain in user_altitude_gain.items() if gain > 0]
+        return sorted(gains, key=lambda x: x[1], reverse=True)[:20]
 
-    def top_20_users_by_altitude_gain(self):
+    def _altitude_gain_legacy(self):
         user_altitude_gain = {}
 
         activities = self.db['Activity'].find({'trackpoint_ids': {'$exists': True, '$not': {'$size': 0}}})
 
-        for activity in tqdm(activities, desc="Processing activities", unit="activity"):
+        for activity in tqdm(activities, desc="Processing activities", unit="activity", disable=not self.verbose):
             user_id = activity['user_id']
             trackpoint_ids = activity['trackpoint_ids']
 
@@ -261,16 +676,81 @@ class Task_2_Program:
                     else:
                         user_altitude_gain[user_id] = altitude_gain
 
-        top_20_users = sorted(user_altitude_gain.items(), key=lambda x: x[1], reverse=True)[:20]
+        return sorted(user_altitude_gain.items(), key=lambda x: x[1], reverse=True)[:20]
 
-        if top_20_users:
-            print("Top 20 Users by Altitude Gain (User ID, Total Meters Gained):")
-            print(tabulate(top_20_users, headers=["User ID", "Total Meters Gained"], tablefmt="grid"))
+    @timed('query_seconds')
+    def find_users_with_invalid_activities(self, engine='auto'):
+        engine = self.resolve_engine(engine)
+
+        invalid_activities_per_user = self._cached('find_users_with_invalid_activities', {'engine': engine}, getattr(self, f'_invalid_activities_{engine}'))
+
+        if invalid_activities_per_user:
+            table_data = [[user_id, count] for user_id, count in sorted(invalid_activities_per_user.items(), key=lambda x: x[1], reverse=True)]
+            table = tabulate(table_data, headers=["User ID", "Invalid Activity Count"], tablefmt="pretty")
+            self.log("Users with Invalid Activities:")
+            self.log(table)
         else:
-            print("No altitude data found.")
+            self.log("No users with invalid activities found.")
+
+        return invalid_activities_per_user
+
+    def _invalid_activities_metrics(self):
+        pipeline = [
+            {
+                '$match': {'max_gap_s': {'$gte': 5 * 60}}
+            },
+            {
+                '$group': {'_id': '$user_id', 'invalid_count': {'$sum': 1}}
+            }
+        ]
+
+        result = self.db['Activity'].aggregate(pipeline)
+        return {user['_id']: user['invalid_count'] for user in result}
 
+    def _invalid_activities_pipeline(self):
+        pipeline = [
+            {
+                '$project': {'user_id': 1}
+            },
+            *self._trackpoint_lookup({}),
+            {
+                '$setWindowFields': {
+                    'partitionBy': '$activity_id',
+                    'sortBy': {'date_time': 1},
+                    'output': {
+                        'prev_date_time': {'$shift': {'output': '$date_time', 'by': -1}}
+                    }
+                }
+            },
+            {
+                '$match': {
+                    'prev_date_time': {'$ne': None},
+                    '$expr': {'$gte': [{'$subtract': ['$date_time', '$prev_date_time']}, 5 * 60 * 1000]}
+                }
+            },
+            {
+                '$group': {'_id': {'activity_id': '$activity_id', 'user_id': '$user_id'}}
+            },
+            {
+                '$group': {'_id': '$_id.user_id', 'invalid_count': {'$sum': 1}}
+            }
+        ]
 
-    def find_users_with_invalid_activities(self):
+        result = self.db['Activity'].aggregate(pipeline, allowDiskUse=True)
+        return {user['_id']: user['invalid_count'] for user in result}
+
+    def _invalid_activities_numpy(self):
+        activity_users = {activity['_id']: activity['user_id']
+                          for activity in self.db['Activity'].find({}, {'user_id': 1})}
+        invalid_activities_per_user = defaultdict(int)
+
+        for activity_id, points in self.load_trackpoint_arrays(activity_users, ()):
+            if max_gap_s(points['date_time']) >= 5 * 60:
+                invalid_activities_per_user[activity_users[activity_id]] += 1
+
+        return dict(invalid_activities_per_user)
+
+    def _invalid_activities_legacy(self):
         invalid_activities_per_user = {}
 
         activities = self.db['Activity'].find({'trackpoint_ids': {'$exists': True, '$not': {'$size': 0}}})
@@ -301,24 +781,46 @@ class Task_2_Program:
                     invalid_activities_per_user[user_id] = 0
                 invalid_activities_per_user[user_id] += 1
 
-        if invalid_activities_per_user:
-            table_data = [[user_id, count] for user_id, count in sorted(invalid_activities_per_user.items(), key=lambda x: x[1], reverse=True)]
-            table = tabulate(table_data, headers=["User ID", "Invalid Activity Count"], tablefmt="pretty")
-            print("Users with Invalid Activities:")
-            print(table)
-        else:
-            print("No users with invalid activities found.")
+        return invalid_activities_per_user
             
-    def find_users_in_forbidden_city(self):
-        forbidden_city_lat = 39.916
-        forbidden_city_lon = 116.397
-        tolerance = 0.001  
-
+    @timed('query_seconds')
+    def find_users_in_forbidden_city(self, forbidden_city_lat=39.916, forbidden_city_lon=116.397, tolerance=0.001,
+                                     engine='box'):
         lat_min = forbidden_city_lat
         lat_max = forbidden_city_lat + tolerance
         lon_min = forbidden_city_lon
         lon_max = forbidden_city_lon + tolerance
 
+        if engine == 'geo':
+            user_ids = self.find_users_in_polygon([
+                (lon_min, lat_min), (lon_max, lat_min), (lon_max, lat_max), (lon_min, lat_max)
+            ])
+        elif engine == 'box' and self.trajectory_buckets():
+            user_ids = self._cached('find_users_in_box_buckets', {'box': (lat_min, lat_max, lon_min, lon_max)},
+                                    lambda: self._bucket_users(
+                                        (lon_min, lat_min, lon_max, lat_max),
+                                        lambda lat, lon: (lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)))
+        elif engine == 'box' and self.trackpoints_denormalized():
+            user_ids = self._cached('find_users_in_box', {'box': (lat_min, lat_max, lon_min, lon_max)},
+                                    lambda: set(self.db['TrackPoint'].distinct(self.tp_field('user_id'), {
+                                        "lat": {"$gte": lat_min, "$lte": lat_max},
+                                        "lon": {"$gte": lon_min, "$lte": lon_max}
+                                    })))
+        else:
+            user_ids = self._cached('find_users_in_box_legacy', {'box': (lat_min, lat_max, lon_min, lon_max)},
+                                    lambda: self._users_in_box_legacy(lat_min, lat_max, lon_min, lon_max))
+
+        if user_ids:
+            self.log("Users who have tracked an activity in the Forbidden City (with tolerance):")
+            for user_id in user_ids:
+                self.log(f"User ID: {user_id}")
+        else:
+            self.log("No users found who have tracked an activity in the Forbidden City.")
+
+        return user_ids
+
+    def _users_in_box_legacy(self, lat_min, lat_max, lon_min, lon_max):
+        self.resolve_engine('legacy')
         matching_trackpoints = self.db['TrackPoint'].find({
             "lat": {"$gte": lat_min, "$lte": lat_max},
             "lon": {"$gte": lon_min, "$lte": lon_max}
@@ -327,27 +829,292 @@ class Task_2_Program:
         trackpoint_ids = [tp['_id'] for tp in matching_trackpoints]
 
         if not trackpoint_ids:
-            print("No trackpoints found within the Forbidden City area.")
-            return
+            self.log("No trackpoints found within the Forbidden City area.")
+            return set()
 
         activities_with_matching_trackpoints = self.db['Activity'].find({
             "trackpoint_ids": {"$in": trackpoint_ids}
         }, {"user_id": 1})  
 
-        user_ids = {activity['user_id'] for activity in activities_with_matching_trackpoints}
+        return {activity['user_id'] for activity in activities_with_matching_trackpoints}
+
+    @timed('query_seconds')
+    def find_users_within_radius(self, lat, lon, radius_m):
+        """
+        Users with a trackpoint within radius_m meters of (lat, lon).
+        Needs TrackPoints loaded with geo=True for the 2dsphere location index,
+        or points loaded with layout='buckets'.
+        """
+        if self.trajectory_buckets():
+            lat_delta = np.degrees(radius_m / 1000 / EARTH_RADIUS_KM)
+            widest = np.radians(min(abs(lat) + lat_delta, 90))
+            lon_delta = min(np.degrees(radius_m / 1000 / EARTH_RADIUS_KM / max(np.cos(widest), 1e-9)), 180)
+            box = (lon - lon_delta, lat - lat_delta, lon + lon_delta, lat + lat_delta)
+            return self._cached('users_within_radius_buckets', {'center': (lat, lon), 'radius_m': radius_m},
+                                lambda: self._bucket_users(box, lambda lats, lons: haversine_m(lats, lons, lat, lon) <= radius_m))
+
+        return self._users_for_trackpoints({
+            'location': {'$geoWithin': {'$centerSphere': [[lon, lat], radius_m / 1000 / EARTH_RADIUS_KM]}}
+        })
 
-        if user_ids:
-            print("Users who have tracked an activity in the Forbidden City (with tolerance):")
-            for user_id in user_ids:
-                print(f"User ID: {user_id}")
+    @timed('query_seconds')
+    def find_users_in_polygon(self, coordinates):
+        """
+        Users with a trackpoint inside the polygon given as (lon, lat) pairs.
+        Needs TrackPoints loaded with geo=True for the 2dsphere location index,
+        or points loaded with layout='buckets'. Bucketed points are tested
+        against straight lon/lat edges, not the geodesic edges of 2dsphere.
+        """
+        ring = [list(point) for point in coordinates]
+        if ring[0] != ring[-1]:
+            ring.append(ring[0])
+
+        if self.trajectory_buckets():
+            lons, lats = zip(*ring)
+            box = (min(lons), min(lats), max(lons), max(lats))
+            return self._cached('users_in_polygon_buckets', {'ring': ring},
+                                lambda: self._bucket_users(box, lambda lat, lon: points_in_polygon(lat, lon, ring)))
+
+        return self._users_for_trackpoints({
+            'location': {'$geoWithin': {'$geometry': {'type': 'Polygon', 'coordinates': [ring]}}}
+        })
+
+    @timed('query_seconds')
+    def find_close_encounters(self, radius_m=100, minutes=5, start=None, end=None):
+        """
+        Pairs of users who were within radius_m meters of each other within
+        the same minutes, optionally only in [start, end). Returns the closest
+        encounter of every pair, closest first.
+        """
+        encounters = self._cached('find_close_encounters',
+                                  {'radius_m': radius_m, 'minutes': minutes, 'start': start, 'end': end},
+                                  lambda: self._close_encounters(radius_m, minutes * 60, start, end))
+
+        if encounters:
+            self.log(f"Users who were within {radius_m} m of each other within {minutes} minutes:")
+            self.log(tabulate([(*encounter['user_ids'], round(encounter['distance_m'], 1), encounter['date_time'])
+                               for encounter in encounters],
+                              headers=["User A", "User B", "Closest (m)", "When"], tablefmt="grid"))
+        else:
+            self.log("No users found close to each other.")
+
+        return encounters
+
+    def _close_encounters(self, radius_m, window_s, start, end):
+        query = {}
+        if start is not None:
+            query['end_date_time'] = {'$gte': start}
+        if end is not None:
+            query['start_date_time'] = {'$lt': end}
+        activity_users = {activity['_id']: activity['user_id']
+                          for activity in self.db['Activity'].find(query, {'user_id': 1})}
+
+        users, groups, lat, lon, date_time = [], [], [], [], []
+        user_index = {}
+        for activity_id, points in self.load_trackpoint_arrays(activity_users, ('lat', 'lon')):
+            keep = np.ones(len(points['date_time']), dtype=bool)
+            if start is not None:
+                keep &= points['date_time'] >= np.datetime64(start, 'ms')
+            if end is not None:
+                keep &= points['date_time'] < np.datetime64(end, 'ms')
+
+            user_id = activity_users[activity_id]
+            if user_id not in user_index:
+                user_index[user_id] = len(users)
+                users.append(user_id)
+            groups.append(np.full(keep.sum(), user_index[user_id]))
+            lat.append(points['lat'][keep])
+            lon.append(points['lon'][keep])
+            date_time.append(points['date_time'][keep])
+
+        if not groups:
+            return []
+
+        groups = np.concatenate(groups)
+        date_time = np.concatenate(date_time)
+        if not len(date_time):
+            return []
+
+        seconds = (date_time - date_time.min()).astype('f8') / 1000
+        i, j, distances = proximity_pairs(groups, np.concatenate(lat), np.concatenate(lon), seconds, radius_m, window_s)
+        if not len(i):
+            return []
+
+        # The closest pair of points for every pair of users
+        first = np.minimum(groups[i], groups[j])
+        second = np.maximum(groups[i], groups[j])
+        order = np.lexsort((distances, second, first))
+        first, second = first[order], second[order]
+        closest = order[np.r_[True, (first[1:] != first[:-1]) | (second[1:] != second[:-1])]]
+
+        encounters = [{
+            'user_ids': tuple(sorted((users[groups[i[k]]], users[groups[j[k]]]))),
+            'distance_m': float(distances[k]),
+            'date_time': date_time[i[k]].item(),
+        } for k in closest]
+        return sorted(encounters, key=lambda encounter: encounter['distance_m'])
+
+    def _bucket_users(self, box, inside):
+        """
+        Users with a point for which inside(lat, lon) holds, read from
+        TrajectoryBucket. box is (lon_min, lat_min, lon_max, lat_max) around
+        the area, only activities whose bbox overlaps it get their points decoded.
+        """
+        lon_min, lat_min, lon_max, lat_max = box
+        activity_users = {activity['_id']: activity['user_id'] for activity in self.db['Activity'].find({
+            'bbox.0': {'$lte': lon_max},
+            'bbox.1': {'$lte': lat_max},
+            'bbox.2': {'$gte': lon_min},
+            'bbox.3': {'$gte': lat_min}
+        }, {'user_id': 1})}
+
+        user_ids = set()
+        for activity_id, points in self.load_trackpoint_arrays(activity_users, ('lat', 'lon')):
+            if activity_users[activity_id] not in user_ids and inside(points['lat'], points['lon']).any():
+                user_ids.add(activity_users[activity_id])
+        return user_ids
+
+    def trackpoints_denormalized(self):
+        """
+        True if the TrackPoints carry user_id themselves, either because they
+        were loaded with denormalize=True or as part of the time-series meta.
+        """
+        if self._denormalized is None:
+            trackpoint = self.db['TrackPoint'].find_one({}, {'user_id': 1, 'meta.user_id': 1})
+            self._denormalized = trackpoint is not None and ('user_id' in trackpoint or 'meta' in trackpoint)
+        return self._denormalized
+
+    def trackpoints_timeseries(self):
+        if self._timeseries is None:
+            info = next(self.db.list_collections(filter={'name': 'TrackPoint'}), None)
+            self._timeseries = info is not None and 'timeseries' in info.get('options', {})
+        return self._timeseries
+
+    def tp_field(self, name):
+        """
+        Path of a TrackPoint field. In a time-series TrackPoint the activity
+        and user fields live under the 'meta' metaField.
+        """
+        if name in ('activity_id', 'user_id', 'transportation_mode') and self.trackpoints_timeseries():
+            return 'meta.' + name
+        return name
+
+    @timed('query_seconds')
+    def count_user_trackpoints(self, user_id, start, end):
+        """
+        Number of trackpoints a user recorded in [start, end). Served from
+        TrackPoint alone when it carries user_id, else through the user's activities.
+        With layout='buckets' buckets inside the range count whole and only
+        the ones on its edges are decoded.
+        """
+        if self.trajectory_buckets():
+            return self._count_bucket_points(user_id, start, end)
+
+        query = {'date_time': {'$gte': start, '$lt': end}}
+        if self.trackpoints_denormalized():
+            query[self.tp_field('user_id')] = user_id
         else:
-            print("No users found who have tracked an activity in the Forbidden City.")
+            query['activity_id'] = {'$in': self.db['Activity'].distinct('_id', {'user_id': user_id})}
+        return self.db['TrackPoint'].count_documents(query)
+
+    def _count_bucket_points(self, user_id, start, end):
+        count = 0
+        buckets = self.db['TrajectoryBucket'].find({
+            'user_id': user_id,
+            'start_date_time': {'$lt': end},
+            'end_date_time': {'$gte': start}
+        }, {'point_count': 1, 'start_date_time': 1, 'end_date_time': 1, 'date_time': 1})
+        for bucket in buckets:
+            if bucket['start_date_time'] >= start and bucket['end_date_time'] < end:
+                count += bucket['point_count']
+            else:
+                date_time = decode_bucket_columns(bucket, ())['date_time']
+                count += int(((date_time >= np.datetime64(start, 'ms')) & (date_time < np.datetime64(end, 'ms'))).sum())
+        return count
+
+    def _users_for_trackpoints(self, query):
+        return self._cached('users_for_trackpoints', {'query': query}, lambda: self._query_users_for_trackpoints(query))
+
+    def _query_users_for_trackpoints(self, query):
+        if self.trackpoints_denormalized():
+            return set(self.db['TrackPoint'].distinct(self.tp_field('user_id'), query))
+
+        activity_ids = self.db['TrackPoint'].distinct('activity_id', query)
+        if not activity_ids:
+            return set()
+        return set(self.db['Activity'].distinct('user_id', {'_id': {'$in': activity_ids}}))
+
+# Everything main() reports on, in the order it prints them
+REPORTS = (
+    'count_users_activities_trackpoints',
+    'avg_activities_per_user',
+    'top_20_users_with_most_activities',
+    'find_taxi_users',
+    'count_transportation_modes',
+    'find_year_with_most_activities_and_hours',
+    'distance_walked',
+    'top_20_users_by_altitude_gain',
+    'find_users_with_invalid_activities',
+    'find_users_in_forbidden_city',
+    'get_most_used_transportation_mode',
+)
+
+
+class ReportRunner:
+    """
+    Runs independent Task 2 reports concurrently on a thread pool. The
+    threads share the program's MongoClient and its connection pool, so the
+    wall time of a run is bounded by the slowest report instead of the sum.
+    """
+
+    def __init__(self, program, max_workers=8):
+        self.program = program
+        self.max_workers = max_workers
+
+    def run(self, reports=REPORTS):
+        """
+        reports holds method names or (name, params) pairs, e.g.
+        ('distance_walked', {'user_id': '010', 'year': 2009, 'mode': 'bus'}).
+        Returns {name: {'params', 'result', 'seconds', 'error'}} in request order.
+        """
+        jobs = [(report, {}) if isinstance(report, str) else report for report in reports]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._run_one, name, params) for name, params in jobs]
+            results = [future.result() for future in futures]
+
+        return {self._label(name, params, jobs): result for (name, params), result in zip(jobs, results)}
+
+    def _run_one(self, name, params):
+        start = time.perf_counter()
+        result, error = None, None
+        try:
+            result = getattr(self.program, name)(**params)
+            if isinstance(result, set):
+                result = sorted(result)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        return {'params': params, 'result': result, 'seconds': time.perf_counter() - start, 'error': error}
+
+    def _label(self, name, params, jobs):
+        # The same report can be requested with different parameters
+        if not params or sum(1 for job_name, _ in jobs if job_name == name) == 1:
+            return name
+        return f"{name}({', '.join(f'{key}={value}' for key, value in sorted(params.items()))})"
+
+
+def run_reports(reports=REPORTS, max_workers=8):
+    program = Task_2_Program(verbose=False)
+    try:
+        return ReportRunner(program, max_workers).run(reports)
+    finally:
+        program.connection.close_connection()
 
 
 def main():
     program = None
     try:
-        program = Task_2_Program()
+        program = Task_2_Program(cache_dir=os.environ.get('QUERY_CACHE_DIR'), profile_dir=os.environ.get('PROFILE_DIR'))
         
         program.show_collections()
         user_count, activity_count, trackpoint_count = program.count_users_activities_trackpoints()
@@ -363,6 +1130,8 @@ def main():
         program.find_users_with_invalid_activities()
         program.find_users_in_forbidden_city()
         program.get_most_used_transportation_mode()
+        if os.environ.get('METRICS_FILE'):
+            program.metrics.write(os.environ['METRICS_FILE'])
     except Exception as e:
         print("ERROR: Failed to use database:", e)
     finally:
@@ -0,0 +1,320 @@
+import numpy as np
+from bson import Binary
+
+# Same mean earth radius as the haversine package
+EARTH_RADIUS_KM = 6371.0088
+
+# Geolife marks a missing altitude with -777 feet
+INVALID_ALTITUDE = -777
+FEET_TO_METERS = 0.3048
+
+
+def segment_distances_km(lat, lon):
+    """
+    Haversine distance in kilometers between every pair of consecutive points.
+    """
+    lat = np.radians(np.asarray(lat, dtype='f8'))
+    lon = np.radians(np.asarray(lon, dtype='f8'))
+    dlat = np.diff(lat)
+    dlon = np.diff(lon)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def distance_km(lat, lon):
+    if len(lat) < 2:
+        return 0.0
+    return float(segment_distances_km(lat, lon).sum())
+
+
+def altitude_gain_m(altitude):
+    """
+    Sum of the positive altitude steps in meters, skipping points without a
+    valid altitude the same way the Task 2 queries do.
+    """
+    altitude = np.asarray(altitude, dtype='f8')
+    steps = np.diff(altitude)
+    gains = (altitude[1:] != INVALID_ALTITUDE) & (steps > 0)
+    return float(steps[gains].sum() * FEET_TO_METERS)
+
+
+def time_gaps_s(date_time):
+    date_time = np.asarray(date_time, dtype='datetime64[ms]')
+    return np.diff(date_time).astype('int64') / 1000.0
+
+
+def max_gap_s(date_time):
+    if len(date_time) < 2:
+        return 0.0
+    return float(time_gaps_s(date_time).max())
+
+
+# Packed columns of a TrajectoryBucket document, date_time is stored as int64 milliseconds
+BUCKET_COLUMNS = ('lat', 'lon', 'altitude', 'date_days')
+
+
+def encode_bucket_columns(columns, start, stop):
+    """
+    Packs rows [start, stop) of parsed .plt columns into little-endian
+    float64/int64 byte strings, stored as BinData.
+    """
+    packed = {name: Binary(np.ascontiguousarray(columns[name][start:stop], dtype='<f8').tobytes())
+              for name in BUCKET_COLUMNS}
+    date_time = columns['date_time'][start:stop].astype('datetime64[ms]').astype('<i8')
+    packed['date_time'] = Binary(date_time.tobytes())
+    return packed
+
+
+def decode_bucket_columns(bucket, names=BUCKET_COLUMNS):
+    """
+    NumPy views over the packed columns of a TrajectoryBucket document.
+    The arrays share memory with the BSON bytes, nothing is copied.
+    """
+    columns = {name: np.frombuffer(bucket[name], dtype='<f8') for name in names}
+    columns['date_time'] = np.frombuffer(bucket['date_time'], dtype='<i8').view('datetime64[ms]')
+    return columns
+
+
+def activity_metrics(columns):
+    """
+    Per-activity numbers the Task 2 reports need, computed once at ingest
+    so they can be aggregated from Activity alone.
+    """
+    date_time = columns['date_time']
+    lat, lon, altitude = columns['lat'], columns['lon'], columns['altitude']
+
+    if len(date_time) > 1 and (np.diff(date_time).astype('int64') < 0).any():
+        order = np.argsort(date_time, kind='stable')
+        date_time, lat, lon, altitude = date_time[order], lat[order], lon[order], altitude[order]
+
+    return {
+        "distance_km": distance_km(lat, lon),
+        "altitude_gain_m": altitude_gain_m(altitude),
+        "max_gap_s": max_gap_s(date_time)
+    }
+
+
+def local_meters(lat, lon, altitude=None):
+    """
+    Points as x/y (and z) meters on a plane tangent at their mean latitude,
+    close enough to the sphere for the extent of one trajectory.
+    """
+    lat = np.asarray(lat, dtype='f8')
+    lon = np.asarray(lon, dtype='f8')
+    scale = EARTH_RADIUS_KM * 1000 * np.pi / 180
+    axes = [(lon - lon[0]) * scale * np.cos(np.radians(lat.mean())), (lat - lat[0]) * scale]
+    if altitude is not None:
+        axes.append(np.asarray(altitude, dtype='f8') * FEET_TO_METERS)
+    return np.column_stack(axes)
+
+
+def douglas_peucker_mask(points, tolerance):
+    """
+    Keep mask of the Douglas-Peucker simplification of a polyline given as
+    an (n, dims) array: every dropped point lies within tolerance of the
+    segment between the kept points around it. Each split measures all the
+    points of a span against its chord in one vectorized step.
+    """
+    keep = np.zeros(len(points), dtype=bool)
+    if len(points) < 3:
+        keep[:] = True
+        return keep
+
+    keep[0] = keep[-1] = True
+    spans = [(0, len(points) - 1)]
+    while spans:
+        start, end = spans.pop()
+        if end - start < 2:
+            continue
+
+        inner = points[start + 1:end]
+        chord = points[end] - points[start]
+        length = chord @ chord
+        offset = inner - points[start]
+        t = np.clip(offset @ chord / length, 0, 1) if length > 0 else np.zeros(len(inner))
+        distances = np.linalg.norm(offset - t[:, None] * chord, axis=1)
+
+        farthest = int(distances.argmax())
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            spans.append((start, split))
+            spans.append((split, end))
+
+    return keep
+
+
+def time_bucket_mask(date_time, step_s, edges=False):
+    """
+    Keep mask holding the first point of every step_s window since the
+    first point, plus the last point. With edges=True the last point of
+    every window is kept too.
+    """
+    milliseconds = np.asarray(date_time).astype('datetime64[ms]').astype('int64')
+    buckets = (milliseconds - milliseconds[0]) // int(step_s * 1000)
+    keep = np.ones(len(buckets), dtype=bool)
+    changes = buckets[1:] != buckets[:-1]
+    keep[1:] = changes
+    if edges:
+        keep[:-1] |= changes
+    keep[-1] = True
+    return keep
+
+
+# Simplification keeps the first and last point of every minute, so a stored
+# gap is either under a minute or one of the original gaps
+SIMPLIFY_ANCHOR_S = 60
+
+
+def simplify_mask(columns, tolerance_m=None, min_step_s=None):
+    """
+    Which points of parsed .plt columns to store. min_step_s thins the
+    points to at most one per min_step_s window, tolerance_m then runs
+    Douglas-Peucker over lat/lon/altitude in meters.
+
+    Error bound: every dropped point lies within tolerance_m (plus the
+    distance covered in min_step_s) of the stored polyline. Distances and
+    altitude gains summed over the stored points can only come out lower
+    than over the original ones. The first and last point of every
+    SIMPLIFY_ANCHOR_S window are always stored. The gap between them is
+    under SIMPLIFY_ANCHOR_S, the gap from one window to the next is an
+    original gap, so the 5 minute gap check finds the same activities.
+    """
+    date_time = columns['date_time']
+    keep = np.ones(len(date_time), dtype=bool)
+    if len(date_time) < 3:
+        return keep
+
+    if min_step_s:
+        keep &= time_bucket_mask(date_time, min_step_s)
+
+    if tolerance_m:
+        kept = np.flatnonzero(keep)
+        points = local_meters(columns['lat'][kept], columns['lon'][kept], columns['altitude'][kept])
+        keep[kept] = douglas_peucker_mask(points, tolerance_m)
+
+    return keep | time_bucket_mask(date_time, SIMPLIFY_ANCHOR_S, edges=True)
+
+
+def grid_rows(lat, cell_m):
+    return np.floor(np.radians(np.asarray(lat, dtype='f8')) * EARTH_RADIUS_KM * 1000 / cell_m).astype('int64')
+
+
+def grid_columns(lon, rows, cell_m):
+    """
+    Column of every point in its latitude row. Rows get narrower in
+    longitude towards the equator, each just wide enough that a point
+    within cell_m meters, even one in the next row, is at most one column away.
+    """
+    radius_m = EARTH_RADIUS_KM * 1000
+    # Latitude of the pole-ward edge of the next row out
+    edge = np.minimum((np.maximum(np.abs(rows), np.abs(rows + 1)) + 1) * cell_m / radius_m, np.pi / 2)
+    width = cell_m / (radius_m * np.maximum(np.cos(edge), 1e-9))
+    return np.floor(np.radians(np.asarray(lon, dtype='f8')) / width).astype('int64')
+
+
+def _dense(values, targets):
+    """
+    Index of each target in the sorted unique values, -1 where it is missing.
+    """
+    index = np.searchsorted(values, targets)
+    index[index == len(values)] = 0
+    return np.where(values[index] == targets, index, -1)
+
+
+# The 3 x 3 x 3 neighbourhood. Columns differ per row, so neighbours are not
+# symmetric and every pair is kept from its lower index instead
+NEIGHBOUR_OFFSETS = [(dx, dy, dt) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dt in (-1, 0, 1)]
+
+
+def proximity_pairs(groups, lat, lon, seconds, radius_m, window_s, max_candidates=2000000):
+    """
+    Pairs of points (i, j) of different groups that are at most radius_m
+    meters and window_s seconds apart, with their distance in meters.
+
+    Points are keyed by grid cell and time bucket, both at least as wide
+    as the thresholds, so a matching point can only sit in the same or a
+    neighbouring cell and bucket. Only those are compared, via a sorted
+    key array and searchsorted, instead of all pairs. Candidates are
+    expanded max_candidates at a time to bound memory.
+    """
+    groups = np.asarray(groups)
+    lat = np.asarray(lat, dtype='f8')
+    lon = np.asarray(lon, dtype='f8')
+    seconds = np.asarray(seconds, dtype='f8')
+    empty = np.empty(0, dtype='int64')
+    if len(lat) < 2:
+        return empty, empty, np.empty(0)
+
+    rows = grid_rows(lat, radius_m)
+    cx = grid_columns(lon, rows, radius_m)
+    ct = np.floor(seconds / window_s).astype('int64')
+    # Dense ids keep the packed keys far from overflowing int64, whatever the extent
+    cy = rows - rows.min() + 1
+    span_y = int(cy.max()) + 2
+    xy_values = np.unique(cx * span_y + cy)
+    t_values = np.unique(ct)
+    keys = _dense(xy_values, cx * span_y + cy) * len(t_values) + _dense(t_values, ct)
+
+    # Work in key order, the lookups below then hit the sorted keys almost sequentially
+    order = np.argsort(keys, kind='stable')
+    groups, lat, lon, seconds = groups[order], lat[order], lon[order], seconds[order]
+    rows, cy, ct, sorted_keys = rows[order], cy[order], ct[order], keys[order]
+
+    # Columns are numbered per row, so every point needs its column in the rows next to it as well
+    columns = {dy: grid_columns(lon, rows + dy, radius_m) for dy in (-1, 0, 1)}
+    neighbour_xy = {(dx, dy): _dense(xy_values, (columns[dy] + dx) * span_y + cy + dy)
+                    for dx in (-1, 0, 1) for dy in (-1, 0, 1)}
+    neighbour_t = {dt: _dense(t_values, ct + dt) for dt in (-1, 0, 1)}
+
+    pairs_i, pairs_j, pairs_d = [], [], []
+    for dx, dy, dt in NEIGHBOUR_OFFSETS:
+        xy, t = neighbour_xy[dx, dy], neighbour_t[dt]
+        valid = (xy >= 0) & (t >= 0)
+        targets = xy * len(t_values) + t
+        left = np.searchsorted(sorted_keys, targets, 'left')
+        counts = np.where(valid, np.searchsorted(sorted_keys, targets, 'right') - left, 0)
+
+        ends = np.cumsum(counts)
+        start = 0
+        while start < len(counts):
+            # Sources whose candidates fit in this round, at least one
+            done = ends[start - 1] if start else 0
+            stop = max(int(np.searchsorted(ends, done + max_candidates, 'right')), start + 1)
+            chunk_counts = counts[start:stop]
+            sources = np.repeat(np.arange(start, stop), chunk_counts)
+            firsts = np.repeat(left[start:stop] - (np.cumsum(chunk_counts) - chunk_counts), chunk_counts)
+            others = firsts + np.arange(len(sources))
+            start = stop
+
+            keep = (sources < others) & (groups[sources] != groups[others])
+            keep &= np.abs(seconds[sources] - seconds[others]) <= window_s
+            sources, others = sources[keep], others[keep]
+
+            distances = haversine_m(lat[sources], lon[sources], lat[others], lon[others])
+            close = distances <= radius_m
+            pairs_i.append(sources[close])
+            pairs_j.append(others[close])
+            pairs_d.append(distances[close])
+
+    return order[np.concatenate(pairs_i)], order[np.concatenate(pairs_j)], np.concatenate(pairs_d)
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(values) for values in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * 1000 * np.arcsin(np.sqrt(a))
+
+
+def points_in_polygon(lat, lon, ring):
+    """
+    Whether each point lies inside the polygon ring of (lon, lat) pairs, by
+    the even-odd rule with straight edges in lon/lat.
+    """
+    inside = np.zeros(len(lat), dtype=bool)
+    for (lon1, lat1), (lon2, lat2) in zip(ring, ring[1:] + ring[:1]):
+        if lat1 == lat2:
+            continue
+        crosses = (lat1 > lat) != (lat2 > lat)
+        inside ^= crosses & (lon < lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1))
+    return inside